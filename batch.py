@@ -0,0 +1,104 @@
+from __future__ import print_function
+import pyifs
+import argparse, copy, glob, json, os, random, time
+from functools import partial
+from multiprocessing import Pool, cpu_count
+import numpy as np
+
+from pyifs.encoding import decode_complex
+from run import new_cache, new_image, new_system, save_outputs
+
+
+def get_args():
+    ap = argparse.ArgumentParser(description="render many configurations through one pool of worker processes")
+    ap.add_argument("inputs", nargs="+",
+                    help="configuration files, directories of them or manifests (text files listing one per line)")
+    ap.add_argument("--workers", type=int, default=0, help="number of worker processes, 0 for one per cpu")
+    ap.add_argument("--sweep", nargs=4, metavar=("FIELD", "START", "STOP", "STEPS"), default=None,
+                    help="render every configuration STEPS times with FIELD, a dotted path into the configuration "
+                         "such as transforms.AffineTransform.1.translation.0, going from START to STOP")
+    ap.add_argument("--cache", default=None,
+                    help="directory of cached renders, an identical render is loaded from it and a larger one continued")
+    ap.add_argument("--cache-size", type=int, default=1024,
+                    help="megabytes the cache may take before the least recently used renders are deleted")
+    return vars(ap.parse_args())
+
+
+def configuration_paths(inputs):
+    ''' expand directories and manifests into the configuration files they contain '''
+    paths = []
+    for path in inputs:
+        if os.path.isdir(path):
+            paths.extend(sorted(glob.glob(os.path.join(path, "*.json"))))
+        elif path.endswith(".json"):
+            paths.append(path)
+        else:
+            with open(path) as f:
+                paths.extend(line.strip() for line in f if line.strip() and not line.startswith("#"))
+    return paths
+
+
+def set_field(config, field, value):
+    ''' set the value at a dotted path into the configuration, numbers index lists '''
+    keys = [int(key) if key.isdigit() else key for key in field.split(".")]
+    target = config
+    for key in keys[:-1]:
+        target = target[key]
+    target[keys[-1]] = value
+
+
+def sweep(config, field, start, stop, steps):
+    ''' copies of config with field going linearly from start to stop, each saved under a numbered path '''
+    root, extension = os.path.splitext(config['image_settings']['path'])
+    for step in range(steps):
+        frame = copy.deepcopy(config)
+        set_field(frame, field, start + (stop - start) * step / max(1, steps - 1))
+        frame['image_settings']['path'] = "{}_{:04d}{}".format(root, step, extension)
+        yield frame
+
+
+def seed_worker():
+    ''' forked workers start with copies of the parent's random state, reseed them so they differ '''
+    random.seed()
+    np.random.seed()
+
+
+def render(config, cache_path=None, cache_size=1024):
+    ''' render one configuration the way run.py does, returning its path, samples and seconds '''
+    start = time.perf_counter()
+    settings = config['evaluation_settings']
+    image = new_image(config)
+    ifs = new_system(config)
+    options = dict(method=settings.get('method', 'scalar'), burn_in=settings.get('burn_in', 0),
+                   seed=settings.get('seed'))
+    if cache_path is None:
+        ifs.evaluate(image, settings['num_points'], settings['iterations'], **options)
+    else:
+        pyifs.cache.evaluate(ifs, image, settings['num_points'], settings['iterations'],
+                             new_cache(cache_path, cache_size), **options)
+    save_outputs(config, ifs, image)
+    return config['image_settings']['path'], settings['num_points'] * settings['iterations'], time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    args = get_args()
+    configs = []
+    for path in configuration_paths(args['inputs']):
+        with open(path) as f:
+            config = json.load(f, object_hook=decode_complex)
+        if args['sweep']:
+            field, start, stop, steps = args['sweep']
+            configs.extend(sweep(config, field, float(start), float(stop), int(steps)))
+        else:
+            configs.append(config)
+
+    start = time.perf_counter()
+    total_samples = 0
+    # the pool outlives every render so workers only import and start up once
+    with Pool(args['workers'] or cpu_count(), initializer=seed_worker) as pool:
+        tasks = partial(render, cache_path=args['cache'], cache_size=args['cache_size'])
+        for path, samples, seconds in pool.imap_unordered(tasks, configs):
+            total_samples += samples
+            print("{:<40} {:>8.2f}s {:>12.0f} samples/s".format(path, seconds, samples / seconds))
+    elapsed = time.perf_counter() - start
+    print("rendered {} images in {:.2f}s, {:.0f} samples/s".format(len(configs), elapsed, total_samples / elapsed))
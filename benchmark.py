@@ -0,0 +1,155 @@
+from __future__ import print_function
+import pyifs
+import argparse, glob, json, os, platform, random, tempfile, time
+import numpy as np
+
+try:
+    import tracemalloc
+except ImportError:  # not every interpreter provides it, e.g. older PyPy
+    tracemalloc = None
+
+from pyifs.encoding import decode_complex
+
+
+def get_args():
+    ap = argparse.ArgumentParser(description="benchmark evaluation, transforms, tone-mapping and png output")
+    ap.add_argument("configurations", nargs="*", default=sorted(glob.glob("configs/*.json")),
+                    help="configuration files to benchmark, all of configs/ by default")
+    ap.add_argument("--size", type=int, default=256, help="width and height of the benchmark images")
+    ap.add_argument("--num-points", type=int, default=200)
+    ap.add_argument("--iterations", type=int, default=200)
+    ap.add_argument("--methods", default="scalar,vectorized", help="comma separated evaluation methods")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--transform-points", type=int, default=10000,
+                    help="number of points each transform is timed on")
+    ap.add_argument("--no-memory", action="store_true",
+                    help="skip the extra runs that measure peak memory")
+    ap.add_argument("--output", default="benchmark.json", help="where to write the results")
+    ap.add_argument("--compare", default=None, help="previous results to report speedups against")
+    return vars(ap.parse_args())
+
+
+def timed(function):
+    ''' run function, returning the seconds it took '''
+    start = time.perf_counter()
+    function()
+    return time.perf_counter() - start
+
+
+def peak_memory(function):
+    ''' run function again with allocation tracing, which slows it down too much to time it at the same
+    time, returning its peak memory in bytes or None if the interpreter cannot trace allocations '''
+    if tracemalloc is None:
+        return None
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def benchmark_configuration(path, size, num_points, iterations, method, seed, memory=True):
+    with open(path) as f:
+        config = json.load(f, object_hook=decode_complex)
+    random.seed(seed)
+    ifs = pyifs.ifs.IFS()
+    ifs.from_dict(config['transforms'])
+    scale = max(1, (num_points * iterations) / (size * size))
+
+    def evaluate(points=num_points):
+        image = pyifs.image.Image(size, size)
+        random.seed(seed)
+        ifs.evaluate(image, points, iterations, method=method, rng=np.random.default_rng(seed))
+        return image
+
+    def save():
+        with tempfile.TemporaryDirectory() as directory:
+            image.save(os.path.join(directory, "out.png"), scale)
+
+    if method == "jit":
+        # a few points first, so the time does not include compiling (or loading) the kernels and starting the threads
+        evaluate(1)
+    start = time.perf_counter()
+    image = evaluate()
+    seconds = time.perf_counter() - start
+    result = {"evaluate_seconds": seconds,
+              "points_per_second": num_points / seconds,
+              "iterations_per_second": num_points * iterations / seconds,
+              "save_seconds": timed(save)}
+    if memory:
+        result["evaluate_peak_bytes"] = peak_memory(evaluate)
+        result["save_peak_bytes"] = peak_memory(save)
+    return result
+
+
+def benchmark_transforms(count, seed):
+    random.seed(seed)
+    transforms = [pyifs.transform.RandomLinearTransform(),
+                  pyifs.transform.RandomAffineTransform(),
+                  pyifs.transform.RandomMoebiusTransform(),
+                  pyifs.transform.RandomInverseJuliaTransform()]
+    rng = np.random.default_rng(seed)
+    px = rng.uniform(-1, 1, count)
+    py = rng.uniform(-1, 1, count)
+    points = list(zip(px.tolist(), py.tolist()))
+    results = {}
+    for t in transforms:
+        scalar_seconds = timed(lambda: [t.transform(x, y) for x, y in points])
+        batch_seconds = timed(lambda: t.transform_batch(px, py, rng=rng))
+        results[type(t).__name__] = {"scalar_ns_per_point": scalar_seconds / count * 1e9,
+                                     "batch_ns_per_point": batch_seconds / count * 1e9}
+    return results
+
+
+def compare(results, previous):
+    ''' print the speedup of every timing in results over the same timing in previous '''
+    for name, timings in results["configurations"].items():
+        for method, result in timings.items():
+            old = previous.get("configurations", {}).get(name, {}).get(method)
+            if "error" in result or not old or "error" in old:
+                continue
+            print("{:<30} {:<12} evaluate x{:.2f} save x{:.2f}".format(
+                name, method, old["evaluate_seconds"] / result["evaluate_seconds"],
+                old["save_seconds"] / result["save_seconds"]))
+    for name, result in results["transforms"].items():
+        old = previous.get("transforms", {}).get(name)
+        if old:
+            print("{:<30} {:<12} scalar x{:.2f} batch x{:.2f}".format(
+                name, "transform", old["scalar_ns_per_point"] / result["scalar_ns_per_point"],
+                old["batch_ns_per_point"] / result["batch_ns_per_point"]))
+
+
+if __name__ == "__main__":
+    args = get_args()
+    results = {"python": platform.python_implementation(),
+               "python_version": platform.python_version(),
+               "numpy_version": np.__version__,
+               "settings": {key: args[key] for key in ("size", "num_points", "iterations", "seed")},
+               "configurations": {},
+               "transforms": benchmark_transforms(args['transform_points'], args['seed'])}
+
+    for path in args['configurations']:
+        name = os.path.splitext(os.path.basename(path))[0]
+        results["configurations"][name] = {}
+        for method in args['methods'].split(","):
+            try:
+                result = benchmark_configuration(path, args['size'], args['num_points'], args['iterations'],
+                                                 method, args['seed'], memory=not args['no_memory'])
+                print("{:<20} {:<12} {:>12.0f} iterations/s  save {:.3f}s".format(
+                    name, method, result["iterations_per_second"], result["save_seconds"]))
+            except Exception as e:
+                # some bundled configurations cannot be loaded, record it rather than stopping the run
+                result = {"error": "{}: {}".format(type(e).__name__, e)}
+                print("{:<20} {:<12} failed, {}".format(name, method, result["error"]))
+            results["configurations"][name][method] = result
+
+    for name, result in results["transforms"].items():
+        print("{:<30} scalar {:>8.0f} ns/point  batch {:>8.1f} ns/point".format(
+            name, result["scalar_ns_per_point"], result["batch_ns_per_point"]))
+
+    with open(args['output'], "w") as f:
+        json.dump(results, f, indent=2)
+
+    if args['compare']:
+        with open(args['compare']) as f:
+            compare(results, json.load(f))
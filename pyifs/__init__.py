@@ -1 +1 @@
-from . import ifs, transform, image
+from . import ifs, transform, image, parallel, checkpoint, instrument, animation, streams, kernel, jit, binary, cache, search, encoding
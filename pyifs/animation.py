@@ -0,0 +1,58 @@
+import numpy as np
+from . import transform
+from .ifs import IFS
+from .image import Image
+
+
+def _lerp(a, b, u):
+    ''' linearly interpolate numbers, complex numbers and (nested) lists of them '''
+    if isinstance(a, (list, tuple)):
+        return [_lerp(x, y, u) for x, y in zip(a, b)]
+    return a + (b - a) * u
+
+
+def interpolate(start, end, u):
+    ''' a new system u of the way (0 to 1) between the systems start and end, which must have the same
+    types of transforms in the same order. parameters, weights, colours and viewports are interpolated linearly
+    '''
+    if len(start.transforms) != len(end.transforms):
+        raise ValueError("keyframes have {} and {} transforms".format(len(start.transforms), len(end.transforms)))
+    system = IFS()
+    for (start_weight, a), (end_weight, b) in zip(start.transforms, end.transforms):
+        name, start_params = a.__dict__()
+        end_name, end_params = b.__dict__()
+        if name != end_name:
+            raise ValueError("cannot interpolate between a {} and a {}".format(name, end_name))
+        params = {key: _lerp(value, end_params[key], u) for key, value in start_params.items()}
+        t = getattr(transform, name)(**params)
+        t.r, t.g, t.b = _lerp([a.r, a.g, a.b], [b.r, b.g, b.b], u)
+        system.add_transform(t, weight=_lerp(start_weight, end_weight, u))
+    system.viewport = tuple(_lerp(start.viewport, end.viewport, u))
+    return system
+
+
+def frame_system(keyframes, frame, frames):
+    ''' the system for frame (0 to frames - 1) of an animation evenly spaced over the keyframes '''
+    position = frame * (len(keyframes) - 1) / max(1, frames - 1)
+    index = min(int(position), len(keyframes) - 2)
+    return interpolate(keyframes[index], keyframes[index + 1], position - index)
+
+
+def animate(keyframes, frames, width, height, num_points, iterations, burn_in=20, initial_burn_in=200, rng=None,
+            dtype=np.float64):
+    ''' render an animation through the keyframe systems, yielding (frame, system, image) for each frame.
+
+    the same num_points walkers are carried from frame to frame. since consecutive systems are close
+    their attractors are too, so each frame only moves the walkers burn_in times before plotting
+    iterations steps, instead of starting from random points, and the frames stay coherent
+    '''
+    if len(keyframes) < 2:
+        raise ValueError("an animation needs at least two keyframes")
+    rng = np.random.default_rng() if rng is None else rng
+    walkers = (rng.uniform(-1, 1, num_points), rng.uniform(-1, 1, num_points), np.zeros((num_points, 3)))
+    for frame in range(frames):
+        system = frame_system(keyframes, frame, frames)
+        image = Image(width, height, dtype=dtype)
+        system.evaluate_vectorized(image, num_points, iterations, rng=rng, walkers=walkers,
+                                   burn_in=initial_burn_in if frame == 0 else burn_in)
+        yield frame, system, image
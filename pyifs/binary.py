@@ -0,0 +1,135 @@
+from functools import lru_cache
+import os
+import numpy as np
+from .ifs import IFS
+
+MAGIC = b"PYIFS\x00"
+VERSION = 1
+
+# type codes of the transforms, never reuse or renumber them as files refer to them
+TYPE_CODES = {"LinearTransform": 0,
+              "AffineTransform": 1,
+              "MoebiusTransform": 2,
+              "InverseJuliaTransform": 3}
+TYPE_NAMES = {code: name for name, code in TYPE_CODES.items()}
+
+# one row per transform: its type code, weight, colour and parameters packed into floats
+ROW = np.dtype([("code", "<u1"), ("weight", "<f8"), ("colour", "<f8", 3), ("params", "<f8", 8)])
+COUNT = np.dtype("<u4")
+
+
+def _pack_params(name, params):
+    ''' the parameters of a transform, as in to_dict, flattened into a list of floats '''
+    if name == "LinearTransform":
+        return [value for row in params["matrix"] for value in row]
+    elif name == "AffineTransform":
+        return [value for row in params["matrix"] for value in row] + list(params["translation"])
+    elif name == "MoebiusTransform":
+        return [part for key in "abcd" for part in (complex(params[key]).real, complex(params[key]).imag)]
+    elif name == "InverseJuliaTransform":
+        return [params["r"], params["theta"]]
+    raise ValueError("{} has no binary format".format(name))
+
+
+def _unpack_params(name, values):
+    ''' the inverse of _pack_params, values is a list of python floats '''
+    if name == "LinearTransform":
+        return {"matrix": [values[0:2], values[2:4]]}
+    elif name == "AffineTransform":
+        return {"matrix": [values[0:2], values[2:4]], "translation": values[4:6]}
+    elif name == "MoebiusTransform":
+        return {key: complex(values[2 * i], values[2 * i + 1]) for i, key in enumerate("abcd")}
+    return {"r": values[0], "theta": values[1]}
+
+
+def to_bytes(ifs):
+    ''' the system in the binary format: the number of transforms followed by a row for each,
+    holding what to_dict would for it. unlike to_dict the order of the transforms is kept
+    '''
+    rows = np.zeros(len(ifs.transforms), dtype=ROW)
+    for row, (weight, t) in zip(rows, ifs.transforms):
+        name, params = t.__dict__()
+        if name not in TYPE_CODES:
+            raise ValueError("{} has no binary format".format(name))
+        values = _pack_params(name, params)
+        row["code"] = TYPE_CODES[name]
+        row["weight"] = weight
+        row["colour"] = (t.r, t.g, t.b)
+        row["params"][:len(values)] = values
+    return np.array(len(rows), dtype=COUNT).tobytes() + rows.tobytes()
+
+
+def _from_rows(rows):
+    ''' the system of an array of rows, each added through from_dict so the order is kept '''
+    ifs = IFS()
+    for code, weight, colour, params in rows.tolist():
+        name = TYPE_NAMES[code]
+        params = _unpack_params(name, params)
+        params["weight"] = weight
+        params["colour"] = colour
+        ifs.from_dict({name: [params]})
+    return ifs
+
+
+def from_bytes(data, offset=0):
+    ''' read a system written by to_bytes starting at offset in data, returning it and the offset after it '''
+    count = int(np.frombuffer(data, dtype=COUNT, count=1, offset=offset)[0])
+    offset += COUNT.itemsize
+    rows = np.frombuffer(data, dtype=ROW, count=count, offset=offset)
+    return _from_rows(rows), offset + count * ROW.itemsize
+
+
+def save(path, systems):
+    ''' write a list of systems to a binary file at path '''
+    with open(path, "wb") as f:
+        f.write(MAGIC + bytes([VERSION]))
+        for ifs in systems:
+            f.write(to_bytes(ifs))
+
+
+def append(path, systems):
+    ''' add systems to the end of a binary file written by save '''
+    with open(path, "ab") as f:
+        for ifs in systems:
+            f.write(to_bytes(ifs))
+
+
+@lru_cache(maxsize=8)
+def _contents(path, size, mtime):
+    ''' the bytes of a file and the offsets of its systems, found from their transform counts alone.
+    kept for the files read most recently, size and mtime are part of the key so a changed file is read again
+    '''
+    with open(path, "rb") as f:
+        data = f.read()
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError("{} is not a binary system file".format(path))
+    if data[len(MAGIC)] != VERSION:
+        raise ValueError("{} has version {}, expected {}".format(path, data[len(MAGIC)], VERSION))
+    offsets = []
+    offset = len(MAGIC) + 1
+    while offset < len(data):
+        offsets.append(offset)
+        count = int(np.frombuffer(data, dtype=COUNT, count=1, offset=offset)[0])
+        offset += COUNT.itemsize + count * ROW.itemsize
+    return data, offsets
+
+
+def _read(path):
+    stat = os.stat(path)
+    return _contents(os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+
+def load(path, indices=None):
+    ''' read the systems in a binary file, all of them or only those at the given indices.
+    the file is read in one go, and reused by later calls until it changes, and each system's
+    rows are parsed as a single array
+    '''
+    data, offsets = _read(path)
+    if indices is not None:
+        offsets = [offsets[index] for index in indices]
+    return [from_bytes(data, offset)[0] for offset in offsets]
+
+
+def count(path):
+    ''' the number of systems in a binary file '''
+    return len(_read(path)[1])
@@ -0,0 +1,138 @@
+import hashlib
+import json
+import os
+import numpy as np
+from . import checkpoint
+from . import instrument
+from .encoding import ComplexEncoder
+from .ifs import ESCAPE_RADIUS
+
+# bump when a change to the engines changes the images they make, so old entries are not reused
+VERSION = 2
+
+# the default limit on the total size of the files in a cache directory
+DEFAULT_MAX_BYTES = 1 << 30
+
+
+def system_hash(ifs):
+    ''' a hash of what to_dict records for every transform of ifs: its type, parameters, weight and colour.
+    the transforms are taken in the order of the system, which decides the image of a seeded render
+    '''
+    transforms = []
+    for weight, t in ifs.transforms:
+        name, params = t.__dict__()
+        transforms.append([name, dict(params, weight=weight, colour=[t.r, t.g, t.b])])
+    return hashlib.sha256(json.dumps(transforms, sort_keys=True, cls=ComplexEncoder).encode()).hexdigest()
+
+
+def render_key(ifs, image, iterations, seed=None, method="scalar", burn_in=0, escape_radius=ESCAPE_RADIUS):
+    ''' the key of a render of ifs into an image like image: everything that decides the accumulation
+    buffer except the number of points, so renders with larger budgets can carry on from a cached one.
+    the tone mapping is applied when saving and is not part of it
+    '''
+    description = {"version": VERSION,
+                   "system": system_hash(ifs),
+                   "width": image.width,
+                   "height": image.height,
+                   "dtype": str(image.data.dtype),
+                   "viewport": list(ifs.viewport),
+                   "iterations": iterations,
+                   "seed": seed,
+                   "method": method,
+                   "burn_in": burn_in,
+                   "escape_radius": escape_radius}
+    return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+
+class RenderCache:
+    ''' a directory of accumulation buffers keyed by render_key, each in a file written like a checkpoint.
+    the least recently used entries are deleted once the files take more than max_bytes
+    '''
+
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".npz")
+
+    def points(self, key):
+        ''' the number of points in the entry for key, 0 if there is none '''
+        try:
+            with np.load(self.path(key), allow_pickle=False) as f:
+                return int(f["points"])
+        except (OSError, KeyError, ValueError):
+            return 0
+
+    def load(self, key, image):
+        ''' copy the entry for key into image, a blank image of the same size, marking it as recently used.
+        returns whether there was an entry
+        '''
+        path = self.path(key)
+        try:
+            with np.load(path, allow_pickle=False) as f:
+                checkpoint.read_buffers(f, image)
+                image.points = int(f["points"])
+        except (OSError, KeyError, ValueError):
+            return False
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            # evicted by another process sharing the directory since it was read, there is nothing to mark
+            pass
+        return True
+
+    def store(self, key, image):
+        ''' write the buffer of image as the entry for key, replacing the file atomically, then evict '''
+        path = self.path(key)
+        # named after the process, so processes sharing the directory never write the same file
+        temporary_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(temporary_path, "wb") as f:
+            np.savez(f, data=np.asarray(image.data), counts=np.asarray(image.counts), points=image.points)
+        os.replace(temporary_path, path)
+        self.evict()
+
+    def evict(self):
+        ''' delete the least recently used entries until the cache fits in max_bytes. entries that
+        another process sharing the directory deletes in the meantime are treated as gone
+        '''
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".npz"):
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+def evaluate(ifs, image, num_points, iterations, cache, method="scalar", seed=None, workers=1, profile=None,
+             burn_in=0, escape_radius=ESCAPE_RADIUS):
+    ''' IFS.evaluate of a blank image through cache, a RenderCache. a cached render of the same key
+    with up to num_points points is loaded and only the rest are evaluated, the result is cached if
+    it has more points than the entry. with a seed the image is the same as rendering without the cache
+    '''
+    if image.points:
+        raise ValueError("cached evaluation needs a blank image, this one has {} points".format(image.points))
+    key = render_key(ifs, image, iterations, seed=seed, method=method, burn_in=burn_in, escape_radius=escape_radius)
+    cached = cache.points(key)
+    if cached and cached <= num_points:
+        with instrument.phase(profile, "cache/load"):
+            cache.load(key, image)
+    if image.points < num_points:
+        ifs.evaluate(image, num_points - image.points, iterations, method=method, seed=seed, workers=workers,
+                     profile=profile, burn_in=burn_in, escape_radius=escape_radius)
+        if image.points > cached:
+            with instrument.phase(profile, "cache/store"):
+                cache.store(key, image)
+    return image
@@ -0,0 +1,86 @@
+import json
+import os
+import random
+import numpy as np
+from .image import Image
+from . import ifs as systems
+from .encoding import ComplexEncoder, decode_complex
+
+
+def _open_array(f, name):
+    ''' the member of the npz file f holding the array name, read up to the array itself, with its shape and dtype '''
+    member = f.zip.open(name + ".npy")
+    version = np.lib.format.read_magic(member)
+    if version == (1, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(member)
+    else:
+        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(member)
+    return member, shape, dtype
+
+
+def read_buffers(f, image):
+    ''' copy the data and counts arrays of the npz file f into the buffers of image, a tile at a time,
+    so a memory-mapped image is filled without holding the arrays in memory
+    '''
+    for name, buffer, channels in (("data", image.data, 3), ("counts", image.counts, 1)):
+        member, shape, dtype = _open_array(f, name)
+        with member:
+            if shape != buffer.shape:
+                raise ValueError("{} has shape {}, expected {}".format(name, shape, buffer.shape))
+            for start, stop in image.tiles():
+                size = (stop - start) * image.width * channels
+                offset = start * image.width * channels
+                buffer[offset:offset + size] = np.frombuffer(member.read(size * dtype.itemsize), dtype=dtype)
+
+
+def save(path, image, iterations, rng, ifs=None):
+    ''' write the raw accumulation buffer of image, the number of points evaluated into it,
+    the iterations per point and the state of rng (a numpy generator) and of the random module
+    to a binary checkpoint at path, with the system ifs (its to_dict, including the weights and
+    colours, and its viewport) if it is given. the file is replaced atomically so an interrupted
+    save leaves the previous checkpoint intact
+    '''
+    version, internal_state, gauss_next = random.getstate()
+    state = {"width": image.width,
+             "height": image.height,
+             "points": image.points,
+             "iterations": iterations,
+             "rng": rng.bit_generator.state,
+             "random": [version, list(internal_state), gauss_next]}
+    if ifs is not None:
+        state["system"] = ifs.to_dict()
+        state["viewport"] = list(ifs.viewport)
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "wb") as f:
+        np.savez(f, data=np.asarray(image.data), counts=np.asarray(image.counts),
+                 state=np.frombuffer(json.dumps(state, cls=ComplexEncoder).encode(), dtype=np.uint8))
+    os.replace(temporary_path, path)
+
+
+def load(path, buffer_path=None, tile_rows=None):
+    ''' read a checkpoint written by save, returning the image, the iterations per point,
+    a numpy generator continuing from the saved state and the system that was evaluated
+    (None for checkpoints saved without one). the state of the random module is restored
+    as well so the scalar method continues its stream.
+    buffer_path and tile_rows are those of the image (see image.Image), with a buffer_path
+    the image is memory-mapped and filled a tile at a time
+    '''
+    with np.load(path, allow_pickle=False) as f:
+        state = json.loads(f["state"].tobytes().decode(), object_hook=decode_complex)
+        member, shape, dtype = _open_array(f, "data")
+        member.close()
+        image = Image(state["width"], state["height"], dtype=dtype, path=buffer_path, tile_rows=tile_rows)
+        read_buffers(f, image)
+    image.points = state["points"]
+
+    rng = np.random.default_rng()
+    rng.bit_generator.state = state["rng"]
+    version, internal_state, gauss_next = state["random"]
+    random.setstate((version, tuple(internal_state), gauss_next))
+
+    ifs = None
+    if "system" in state:
+        ifs = systems.IFS()
+        ifs.from_dict(state["system"])
+        ifs.viewport = tuple(state["viewport"])
+    return image, state["iterations"], rng, ifs
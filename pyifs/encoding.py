@@ -0,0 +1,18 @@
+import json
+
+
+# Since complex numbers are not natively json serializable here is an encoder and decoder to handle them
+class ComplexEncoder(json.JSONEncoder):
+    ''' a json encoder writing complex numbers as {"__complex__": true, "real": ..., "imag": ...} '''
+    def default(self, z):
+        if isinstance(z, complex):
+            return {"__complex__": True, "real": z.real, "imag": z.imag}
+        else:
+            return super().default(z)
+
+
+def decode_complex(dct):
+    ''' the object_hook for json.load that reads back the complex numbers written by ComplexEncoder '''
+    if '__complex__' in dct:
+        return complex(dct['real'], dct['imag'])
+    return dct
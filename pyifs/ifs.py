@@ -1,5 +1,42 @@
 import random
+import time
+from bisect import bisect_right
+from math import floor
+import numpy as np
 from . import transform
+from . import parallel
+from . import checkpoint
+from . import instrument
+from . import streams
+from . import kernel
+from . import jit
+
+# the most samples the vectorized engine collects before binning them into the image
+MAX_PENDING_SAMPLES = 1 << 22
+
+# walkers further than this from the origin (or not finite) are considered to have diverged
+ESCAPE_RADIUS = 1e8
+
+# the region (xmin, xmax, ymin, ymax) of the plane drawn on the image unless another viewport is set
+DEFAULT_VIEWPORT = (-2.0, 2.0, -2.0, 2.0)
+
+# the most samples the compiled scalar engine collects before binning them into the image
+SCALAR_PENDING_SAMPLES = 1 << 16
+
+# the deterministic method settles after this many steps, or earlier once the density changes by less than the
+# tolerance or has stopped changing less (by a tenth over DETERMINISTIC_STALL_STEPS steps)
+DETERMINISTIC_STEPS = 100
+DETERMINISTIC_TOLERANCE = 1e-4
+DETERMINISTIC_STALL_STEPS = 5
+# the points of the deterministic method start this many across and down every pixel, and are merged
+# when they land in the same cell of a grid this many times finer than the pixels
+DETERMINISTIC_SUBSAMPLES = 2
+# once settled it takes this many more steps with cells DETERMINISTIC_REFINEMENT times finer still,
+# filling in the pixels where the attractor is thinner than a cell
+DETERMINISTIC_REFINE_STEPS = 4
+DETERMINISTIC_REFINEMENT = 4
+# refining stops short of this many points, so attractors that fill an area stay within memory and time
+DETERMINISTIC_MAX_POINTS = 1 << 21
 
 
 class IFS:
@@ -8,79 +45,865 @@ class IFS:
     def __init__(self):
         self.transforms = []
         self.total_weight = 0
+        # running totals of the weights, searched with bisect when choosing a transform
+        self.cumulative_weights = []
+        self._cumulative_array = None
+        self.viewport = DEFAULT_VIEWPORT
 
     def random(self, count,
                allowed_transforms=[transform.RandomAffineTransform,
                                    transform.RandomMoebiusTransform,
-                                   transform.RandomInverseJuliaTransform]):
-        for t in random.choices(allowed_transforms, k=count):
-            self.add_transform(t)
+                                   transform.RandomInverseJuliaTransform],
+               rng=None):
+        ''' add count random transforms, drawn from rng (a numpy generator) if it is given '''
+        if rng is None:
+            chosen = random.choices(allowed_transforms, k=count)
+        else:
+            chosen = [allowed_transforms[i] for i in rng.integers(len(allowed_transforms), size=count)]
+        for t in chosen:
+            self.add_transform(t(rng=rng), rng=rng)
         
-    def from_dict(self, dictionary):
+    def from_dict(self, dictionary, rng=None):
         ''' read in from a dictionary
-        this has easy support for reading in from the json transforms section 
+        this has easy support for reading in from the json transforms section,
+        each transform may have a "weight" and a "colour" [r, g, b], otherwise they are assigned randomly.
+        missing colours and weights are drawn from rng (a numpy generator) if it is given
         '''
         for transform_type in dictionary:
             transform_class = getattr(transform, transform_type)
             for t in dictionary[transform_type]:
-                self.add_transform(transform_class(**t))
+                params = dict(t)
+                weight = params.pop("weight", None)
+                colour = params.pop("colour", None)
+                new = transform_class(rng=rng, **params)
+                if colour is not None:
+                    new.set_colour(*colour)
+                self.add_transform(new, weight=weight, rng=rng)
 
     def to_dict(self):
         d = dict()
         for weight, transform in self.transforms:
             name, params = transform.__dict__()
+            params["weight"] = weight
+            params["colour"] = [transform.r, transform.g, transform.b]
             if name in d:
                 d[name].append(params)
             else:
                 d[name] = [params]
         return d
     
-    def add_transform(self, transform, weight=None):
-        ''' append a transform to the system, the weight is assigned randomly if not passed'''
-        if not weight:
+    def add_transform(self, transform, weight=None, rng=None):
+        ''' append a transform to the system, the weight is assigned randomly (from rng if it is given)
+        if not passed. a weight of 0 is kept, so the transform is never chosen
+        '''
+        if weight is None and rng is None:
             weight = random.gauss(1, 0.15) * random.gauss(1, 0.15)
+        elif weight is None:
+            weight = rng.normal(1, 0.15) * rng.normal(1, 0.15)
+        if weight < 0:
+            raise ValueError("transform weights must not be negative, got {}".format(weight))
         self.total_weight += weight
         self.transforms.append((weight, transform))
+        self.cumulative_weights.append(self.total_weight)
+        self._cumulative_array = None
+
+    def compile(self):
+        ''' the transforms compiled into a kernel.Table that the evaluation engines step through
+        without calling the transforms, or None if some transform cannot be compiled.
+        it is made afresh on every call, which is cheap, and the engines call it once at the start
+        of each evaluation, so changes made to the transforms in place are always picked up
+        '''
+        return kernel.compile_system(self)
     
-    def _choose_transform(self):
+    def _choose_transform(self, rng=None):
         ''' choose a transform at random using the weighting ''' 
-        w = random.random() * self.total_weight
-        running_total = 0
-        for weight, transform in self.transforms:
-            running_total += weight
-            if w <= running_total:
-                return transform
+        return self.transforms[self._choose_transform_index(rng)][1]
+
+    def _choose_transform_index(self, rng=None):
+        ''' choose the index of a transform at random using the weighting, by bisecting the running totals '''
+        kernel.check_total_weight(self.total_weight)
+        w = (random.random() if rng is None else rng.random()) * self.total_weight
+        # the product can round up to the total, which would be past the last transform
+        return min(bisect_right(self.cumulative_weights, w), len(self.transforms) - 1)
+
+    def _choose_transform_indices(self, count, rng=None):
+        ''' choose count transform indices at once using the weighting '''
+        kernel.check_total_weight(self.total_weight)
+        rng = np.random if rng is None else rng
+        w = rng.random(count) * self.total_weight
+        return np.minimum(np.searchsorted(self._cumulative(), w, side="right"), len(self.transforms) - 1)
+
+    def _cumulative(self):
+        ''' the running totals of the weights as a numpy array, kept until a transform is added '''
+        if self._cumulative_array is None:
+            self._cumulative_array = np.array(self.cumulative_weights)
+        return self._cumulative_array
     
+    def _step_walkers(self, px, py, colours, rng, table, profile=None, bits=None):
+        ''' move every walker (and its colour) by a randomly chosen transform, in place.
+        table is the compiled system (see compile), which takes one fused step, if it is None
+        the walkers go through the transforms one at a time and with a profile each of them is timed.
+        bits are optional random bits of every walker that choose the transforms (see streams.choices)
+        in place of rng, which transforms that draw random numbers of their own still use
+        '''
+        if table is not None:
+            with instrument.phase(profile, "evaluate/choose transform"):
+                if bits is None:
+                    choices, negate = table.choose_indices(len(px), rng), None
+                else:
+                    choices = streams.choices(bits, table.cumulative, table.total_weight)
+                    negate = streams.negations(bits)
+            if profile is None:
+                table.step_batch(px, py, colours, choices, rng, negate)
+                return
+            seconds = [0.0] * len(self.transforms)
+            table.step_batch(px, py, colours, choices, rng, negate, seconds=seconds)
+            calls = np.bincount(choices, minlength=len(self.transforms)).tolist()
+            for index, (weight, t) in enumerate(self.transforms):
+                profile.add_transform_time(index, t, weight, calls[index], seconds[index])
+            return
+        with instrument.phase(profile, "evaluate/choose transform"):
+            if bits is None:
+                choices = self._choose_transform_indices(len(px), rng)
+            else:
+                kernel.check_total_weight(self.total_weight)
+                choices = streams.choices(bits, self._cumulative(), self.total_weight)
+        for index, (weight, t) in enumerate(self.transforms):
+            selected = np.flatnonzero(choices == index)
+            if len(selected) == 0:
+                continue
+            start = time.perf_counter() if profile is not None else None
+            px[selected], py[selected] = t.transform_batch(px[selected], py[selected], rng=rng)
+            r, g, b = t.transform_colour_batch(*colours[selected].T)
+            colours[selected] = np.column_stack((r, g, b))
+            if profile is not None:
+                profile.add_transform_time(index, t, weight, len(selected), time.perf_counter() - start)
+
+    def _reseed_diverged(self, px, py, colours, escape_radius, rng):
+        ''' move walkers that have diverged beyond escape_radius (or are not finite) onto the
+        positions and colours of randomly chosen live walkers, or back to random starting points
+        if none are left
+        '''
+        alive = (np.abs(px) < escape_radius) & (np.abs(py) < escape_radius)
+        if alive.all():
+            return
+        diverged = np.flatnonzero(~alive)
+        live = np.flatnonzero(alive)
+        if len(live) == 0:
+            px[:] = rng.uniform(-1, 1, len(px))
+            py[:] = rng.uniform(-1, 1, len(py))
+            return
+        donors = live[(rng.random(len(diverged)) * len(live)).astype(np.int64)]
+        px[diverged] = px[donors]
+        py[diverged] = py[donors]
+        colours[diverged] = colours[donors]
+
+    @staticmethod
+    def _restore_diverged(px, py, colours, last, escape_radius):
+        ''' move walkers that have diverged beyond escape_radius (or are not finite) back to their
+        last live positions and colours in last, a (px, py, colours) tuple of arrays that is updated
+        in place with the others. returns which walkers are live, as the scalar engines do the
+        restored ones are not plotted this step
+        '''
+        alive = (np.abs(px) < escape_radius) & (np.abs(py) < escape_radius)
+        last_x, last_y, last_colours = last
+        if alive.all():
+            last_x[:], last_y[:], last_colours[:] = px, py, colours
+            return alive
+        diverged = ~alive
+        px[diverged], py[diverged], colours[diverged] = last_x[diverged], last_y[diverged], last_colours[diverged]
+        last_x[alive], last_y[alive], last_colours[alive] = px[alive], py[alive], colours[alive]
+        return alive
+
     def _final_transform(self, px, py):
-        ''' an internal helper function to convert point into proper projection for image plotting '''
-        a = 0.5
-        b = 0
-        c = 0
-        d = 1
-        z = complex(px, py)
-        z2 = (a * z + b) / (c * z + d)
-        return z2.real, z2.imag
-
-    def evaluate(self, image, num_points, iterations):
+        ''' an internal helper function to convert point into proper projection for image plotting,
+        the viewport is mapped onto [-1, 1] x [-1, 1]
+        '''
+        xmin, xmax, ymin, ymax = self.viewport
+        return 2 * (px - xmin) / (xmax - xmin) - 1, 2 * (py - ymin) / (ymax - ymin) - 1
+
+    def _final_transform_batch(self, px, py):
+        ''' the same projection as _final_transform applied to numpy arrays of points '''
+        return self._final_transform(px, py)
+
+    def estimate_viewport(self, aspect=1.0, num_points=1000, iterations=100, burn_in=20,
+                          percentiles=(0.5, 99.5), margin=0.05, rng=None):
+        ''' set the viewport to fit the attractor, estimated from a small sample of num_points
+        walkers after burn_in steps. the robust bounding box between the percentiles of the
+        samples is padded by margin on each side and widened to the aspect ratio (width / height)
+        of the image it will be drawn on. returns the new viewport
+        '''
+        rng = np.random if rng is None else rng
+        table = self.compile()
+        px = rng.uniform(-1, 1, num_points)
+        py = rng.uniform(-1, 1, num_points)
+        colours = np.zeros((num_points, 3))
+        xs, ys = [], []
+        for j in range(burn_in + iterations):
+            self._step_walkers(px, py, colours, rng, table)
+            self._reseed_diverged(px, py, colours, ESCAPE_RADIUS, rng)
+            if j >= burn_in:
+                xs.append(px.copy())
+                ys.append(py.copy())
+        return self._fit_viewport(np.concatenate(xs), np.concatenate(ys), aspect, percentiles, margin)
+
+    def _fit_viewport(self, xs, ys, aspect, percentiles, margin):
+        ''' set the viewport to the box around the samples xs, ys described in estimate_viewport '''
+        xmin, xmax = np.percentile(xs, percentiles)
+        ymin, ymax = np.percentile(ys, percentiles)
+
+        # pad, avoid an empty box for attractors that are a line or a point, then match the aspect ratio
+        width = max(xmax - xmin, 1e-9) * (1 + 2 * margin)
+        height = max(ymax - ymin, 1e-9) * (1 + 2 * margin)
+        width, height = max(width, height * aspect), max(height, width / aspect)
+        x, y = (xmin + xmax) / 2, (ymin + ymax) / 2
+        self.viewport = tuple(float(v) for v in (x - width / 2, x + width / 2, y - height / 2, y + height / 2))
+        return self.viewport
+
+    def screen(self, size=64, aspect=1.0, num_points=256, iterations=64, burn_in=16, escape_radius=ESCAPE_RADIUS,
+               rng=None):
+        ''' cheap measures of how the system would render, from num_points walkers moved burn_in + iterations
+        times and binned on a canvas size pixels wide, for screening random systems before rendering them.
+        the viewport is fitted to the samples as by estimate_viewport. returns a dictionary of
+        coverage: the fraction of the pixels of the canvas that are hit,
+        entropy: the entropy of the distribution of samples over the pixels, 1 when they are spread evenly,
+        escape_rate: the fraction of steps after which a walker diverged (or became nan),
+        contraction: the mean factor by which the transforms shrink lengths near the attractor, from the
+        determinants of their jacobians weighted like the transforms are chosen, below 1 for a contractive system
+        '''
+        rng = np.random if rng is None else rng
+        table = self.compile()
+        px = rng.uniform(-1, 1, num_points)
+        py = rng.uniform(-1, 1, num_points)
+        colours = np.zeros((num_points, 3))
+        xs, ys = [], []
+        escaped = 0
+        for j in range(burn_in + iterations):
+            self._step_walkers(px, py, colours, rng, table)
+            escaped += num_points - np.count_nonzero((np.abs(px) < escape_radius) & (np.abs(py) < escape_radius))
+            self._reseed_diverged(px, py, colours, escape_radius, rng)
+            if j >= burn_in:
+                xs.append(px.copy())
+                ys.append(py.copy())
+        xs, ys = np.concatenate(xs), np.concatenate(ys)
+        keep = np.isfinite(xs) & np.isfinite(ys)
+        xs, ys = xs[keep], ys[keep]
+        live = np.isfinite(px) & np.isfinite(py)
+        metrics = {"coverage": 0.0, "entropy": 0.0,
+                   "escape_rate": int(escaped) / (num_points * (burn_in + iterations)),
+                   "contraction": self._contraction(px[live], py[live])}
+        if len(xs) == 0:
+            return metrics
+
+        width, height = size, max(1, int(round(size / aspect)))
+        xmin, xmax, ymin, ymax = self._fit_viewport(xs, ys, aspect, (0.5, 99.5), 0.05)
+        fx = (xs - xmin) * (width / (xmax - xmin))
+        fy = (ys - ymin) * (height / (ymax - ymin))
+        inside = (fx >= 0) & (fx < width) & (fy >= 0) & (fy < height)
+        counts = np.bincount(fx[inside].astype(np.int64) + fy[inside].astype(np.int64) * width,
+                             minlength=width * height)
+        hit = counts[counts > 0] / counts.sum()
+        metrics["coverage"] = float(len(hit) / (width * height))
+        metrics["entropy"] = float(-(hit * np.log(hit)).sum() / np.log(width * height))
+        return metrics
+
+    def _contraction(self, px, py, step=1e-6):
+        ''' the weighted geometric mean over the transforms of the square root of the absolute determinant
+        of their jacobians at the points px, py, found by finite differences. each transform is evaluated
+        with the same fresh generator at the three points so random branches are taken alike
+        '''
+        if len(px) == 0 or not self.transforms:
+            return float("inf")
+        total, logs = 0.0, 0.0
+        for weight, t in self.transforms:
+            x0, y0 = t.transform_batch(px, py, rng=np.random.default_rng(0))
+            xx, yx = t.transform_batch(px + step, py, rng=np.random.default_rng(0))
+            xy, yy = t.transform_batch(px, py + step, rng=np.random.default_rng(0))
+            determinant = np.abs((xx - x0) * (yy - y0) - (xy - x0) * (yx - y0)) / (step * step)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                log = 0.5 * np.log(determinant)
+            log = log[np.isfinite(log)]
+            if len(log):
+                logs += weight * log.mean()
+                total += weight
+        return float(np.exp(logs / total)) if total > 0 else float("inf")
+
+    def evaluate(self, image, num_points, iterations, method="scalar", rng=None, workers=1, seed=None,
+                 checkpoint_path=None, checkpoint_interval=None, profile=None, burn_in=0,
+                 escape_radius=ESCAPE_RADIUS, first_point=None):
         ''' given an input image from the image class, 
         evaluate the iterated function system probabilistically using
         num_points for specified number of iterations
+
+        method is either "scalar", which moves one point at a time,
+        "vectorized", which moves all points together as numpy arrays, "jit", which compiles
+        the chaos game with numba if it is installed (see jit.evaluate_jit) and is "vectorized" otherwise,
+        or "deterministic", which iterates the whole set of pixels without any randomness (see
+        evaluate_deterministic, the options of the chaos game do not apply to it).
+        rng is an optional numpy random generator, without one the scalar method uses the random module
+        and the vectorized method the global numpy state.
+        if seed is given the evaluation is reproducible and rng is not used, see _evaluate_seeded
+        for how the points are numbered from first_point.
+        if workers is not 1 the points are split across that many processes (None for one per cpu),
+        each with an independent random stream spawned from seed.
+        if checkpoint_path is given the points are evaluated checkpoint_interval at a time,
+        saving a checkpoint after each, see _evaluate_checkpointed.
+        profile is an optional instrument.Profile that collects timings and counters,
+        without one no bookkeeping is done.
+        each point is moved burn_in times before it starts being plotted, so it is on the attractor.
+        points that diverge beyond escape_radius (or become nan) are not plotted and continue from
+        a live position instead
+        '''
+        if method == "deterministic":
+            return self.evaluate_deterministic(image, num_points, iterations, profile=profile)
+        options = dict(burn_in=burn_in, escape_radius=escape_radius)
+        if checkpoint_path is not None:
+            return self._evaluate_checkpointed(image, num_points, iterations, checkpoint_path,
+                                               checkpoint_interval or num_points, method=method, rng=rng,
+                                               workers=workers, seed=seed, profile=profile, **options)
+        if seed is not None and workers == 1:
+            return self._evaluate_seeded(image, num_points, iterations, seed, method=method, profile=profile,
+                                         first_point=first_point, **options)
+        if profile is not None:
+            return self._evaluate_profiled(image, num_points, iterations, profile, method=method, rng=rng,
+                                           workers=workers, seed=seed, first_point=first_point, **options)
+        if workers != 1:
+            return parallel.evaluate_parallel(self, image, num_points, iterations, workers=workers, method=method,
+                                              seed=seed, first_point=first_point, **options)
+        return self._evaluate_engine(image, num_points, iterations, method, rng=rng, **options)
+
+    def _evaluate_engine(self, image, num_points, iterations, method, rng=None, point_streams=None, profile=None,
+                         burn_in=0, escape_radius=ESCAPE_RADIUS):
+        ''' evaluate in this process with the engine of method, drawing from rng or, for a seeded
+        evaluation, from point_streams (a streams.PointStreams of the points)
+        '''
+        options = dict(point_streams=point_streams, profile=profile, burn_in=burn_in, escape_radius=escape_radius)
+        if method == "vectorized":
+            return self.evaluate_vectorized(image, num_points, iterations, rng=rng, **options)
+        elif method == "jit":
+            return jit.evaluate_jit(self, image, num_points, iterations, rng=rng, **options)
+        elif method != "scalar":
+            raise ValueError("unknown evaluation method: {}".format(method))
+        table = self.compile()
+        if table is not None:
+            return self._evaluate_scalar_compiled(image, num_points, iterations, table, rng=rng, **options)
+        if profile is not None:
+            return self._evaluate_scalar_profiled(image, num_points, iterations, rng=rng, **options)
+        del options["profile"]
+        return self._evaluate_scalar(image, num_points, iterations, rng=rng, **options)
+
+    def _evaluate_scalar(self, image, num_points, iterations, rng=None, point_streams=None, burn_in=0,
+                         escape_radius=ESCAPE_RADIUS):
+        ''' the scalar method of evaluate for systems that do not compile, calling the transforms of
+        each point in turn. with point_streams the transforms that draw random numbers of their own
+        get a generator for every point
         '''
         width, height = image.width, image.height
-        for i in range(num_points): 
-            px = random.uniform(-1, 1)
-            py = random.uniform(-1, 1)
+        if point_streams is not None:
+            kernel.check_total_weight(self.total_weight)
+            starts = zip(*(coordinates.tolist() for coordinates in point_streams.start()))
+            cumulative = self._cumulative()
+        for i in range(num_points):
+            if point_streams is None:
+                px = transform.uniform(-1, 1, rng)
+                py = transform.uniform(-1, 1, rng)
+            else:
+                px, py = next(starts)
+                indices = streams.choices(point_streams.walk(i, 2, burn_in + iterations), cumulative,
+                                          self.total_weight).tolist()
+                rng = point_streams.generator(i)
             r, g, b = 0.0, 0.0, 0.0
-    
-            for j in range(iterations):
-                t = self._choose_transform()
-                px, py = t.transform(px, py)
+            last = px, py, r, g, b
+
+            for j in range(burn_in + iterations):
+                t = self._choose_transform(rng) if point_streams is None else self.transforms[indices[j]][1]
+                try:
+                    px, py = t.transform(px, py, rng=rng)
+                except ZeroDivisionError:
+                    # landed on a pole, e.g. of a Moebius transform, which is diverging too
+                    px, py, r, g, b = last
+                    continue
                 r, g, b = t.transform_colour(r, g, b)
+                if not (abs(px) < escape_radius and abs(py) < escape_radius):
+                    # diverged, carry on from the last live position instead
+                    px, py, r, g, b = last
+                    continue
+                last = px, py, r, g, b
+                if j < burn_in:
+                    continue
                 
                 fx, fy = self._final_transform(px, py)
-                x = int((fx + 1) * width / 2)
-                y = int((fy + 1) * height / 2)
+                x = floor((fx + 1) * width / 2)
+                y = floor((fy + 1) * height / 2)
                 image.add_radiance(x, y, [r, g, b])
+        image.points += num_points
         return image
 
-    
+    def _evaluate_scalar_compiled(self, image, num_points, iterations, table, rng=None, point_streams=None,
+                                  profile=None, burn_in=0, escape_radius=ESCAPE_RADIUS):
+        ''' the scalar method of evaluate moving each point with the fused step of table, the compiled
+        system, the transforms of each point are chosen all at once and its samples are collected,
+        then projected and binned into the image in bulk. with a profile the choices, the walks,
+        the projection and the binning are timed between the passes that bin the samples, and the
+        steps of every transform are counted and timed
+        '''
+        clock = time.perf_counter
+        step = table.step
+        # the branches of inverse Julia transforms are drawn with the transforms, rather than one at a time
+        signs = kernel.INVERSE_JULIA in table.families
+        cumulative = table.cumulative.tolist()
+        last_index = len(cumulative) - 1
+        total_weight = table.total_weight
+        kernel.check_total_weight(total_weight)
+        if profile is not None:
+            calls = [0] * len(cumulative)
+            seconds = [0.0] * len(cumulative)
+
+            def step(index, *args, fused=table.step):
+                start = clock()
+                try:
+                    return fused(index, *args)
+                finally:
+                    seconds[index] += clock() - start
+                    calls[index] += 1
+        width, height = image.width, image.height
+        xmin, xmax, ymin, ymax = self.viewport
+        x_scale = width / (xmax - xmin)
+        y_scale = height / (ymax - ymin)
+        # samples outside of the image are dropped anyway, limit them so the integer conversion is safe
+        limit = 2 * max(width, height)
+        xs, ys, rs, gs, bs = [], [], [], [], []
+        if point_streams is not None:
+            starts = zip(*(coordinates.tolist() for coordinates in point_streams.start()))
+        walk_start = clock()
+        choose_seconds = 0.0
+        for i in range(num_points):
+            chosen = clock()
+            if point_streams is None:
+                px = transform.uniform(-1, 1, rng)
+                py = transform.uniform(-1, 1, rng)
+                if signs:
+                    negates = _sign_bits(burn_in + iterations, rng)
+                if rng is not None:
+                    indices = table.choose_indices(burn_in + iterations, rng).tolist()
+                else:
+                    indices = [min(bisect_right(cumulative, random.random() * total_weight), last_index)
+                               for j in range(burn_in + iterations)]
+            else:
+                px, py = next(starts)
+                bits = point_streams.walk(i, 2, burn_in + iterations)
+                indices = streams.choices(bits, table.cumulative, total_weight).tolist()
+                negates = streams.negations(bits).tolist()
+            choose_seconds += clock() - chosen
+            r, g, b = 0.0, 0.0, 0.0
+            last = px, py, r, g, b
+
+            for j in range(burn_in + iterations):
+                index = indices[j]
+                try:
+                    px, py, r, g, b = step(index, px, py, r, g, b, negates[j] if signs else False)
+                except ZeroDivisionError:
+                    # landed on a pole, e.g. of a Moebius transform, which is diverging too
+                    px, py, r, g, b = last
+                    continue
+                if not (abs(px) < escape_radius and abs(py) < escape_radius):
+                    # diverged, carry on from the last live position instead
+                    px, py, r, g, b = last
+                    continue
+                last = px, py, r, g, b
+                if j < burn_in:
+                    continue
+
+                xs.append(px)
+                ys.append(py)
+                rs.append(r)
+                gs.append(g)
+                bs.append(b)
+            if len(xs) >= SCALAR_PENDING_SAMPLES or i == num_points - 1:
+                if profile is not None:
+                    profile.add_phase_time("evaluate/choose transform", choose_seconds)
+                    profile.add_phase_time("evaluate/walk", clock() - walk_start - choose_seconds)
+                with instrument.phase(profile, "evaluate/final transform"):
+                    x = np.floor(np.clip((np.array(xs) - xmin) * x_scale, -limit, limit)).astype(np.int64)
+                    y = np.floor(np.clip((np.array(ys) - ymin) * y_scale, -limit, limit)).astype(np.int64)
+                with instrument.phase(profile, "evaluate/add radiance"):
+                    image.add_radiance_batch(x, y, np.column_stack((rs, gs, bs)))
+                xs, ys, rs, gs, bs = [], [], [], [], []
+                walk_start = clock()
+                choose_seconds = 0.0
+        if profile is not None:
+            for index, (weight, t) in enumerate(self.transforms):
+                profile.add_transform_time(index, t, weight, calls[index], seconds[index])
+        image.points += num_points
+        return image
+
+    def _evaluate_profiled(self, image, num_points, iterations, profile, method="scalar", rng=None,
+                           point_streams=None, workers=1, seed=None, first_point=None, burn_in=0,
+                           escape_radius=ESCAPE_RADIUS):
+        ''' evaluate while recording timings into profile, the rate of samples landing
+        inside the image comes from the change in its sample counts
+        '''
+        options = dict(burn_in=burn_in, escape_radius=escape_radius)
+        inside = int(image.counts.sum())
+        with profile.phase("evaluate"):
+            if workers != 1:
+                parallel.evaluate_parallel(self, image, num_points, iterations, workers=workers, method=method,
+                                           seed=seed, first_point=first_point, profile=profile, **options)
+            else:
+                # the same engines as without a profile
+                self._evaluate_engine(image, num_points, iterations, method, rng=rng, point_streams=point_streams,
+                                      profile=profile, **options)
+        profile.add_samples(num_points * iterations, int(image.counts.sum()) - inside)
+        return image
+
+    def _evaluate_scalar_profiled(self, image, num_points, iterations, profile, rng=None, point_streams=None,
+                                  burn_in=0, escape_radius=ESCAPE_RADIUS):
+        ''' the scalar method of evaluate with every step timed, kept separate so the
+        unprofiled loop pays nothing for it
+        '''
+        clock = time.perf_counter
+        width, height = image.width, image.height
+        indices = {id(t): index for index, (weight, t) in enumerate(self.transforms)}
+        calls = [0] * len(self.transforms)
+        seconds = [0.0] * len(self.transforms)
+        choose_seconds = final_seconds = add_seconds = 0.0
+        if point_streams is not None:
+            kernel.check_total_weight(self.total_weight)
+            starts = zip(*(coordinates.tolist() for coordinates in point_streams.start()))
+            cumulative = self._cumulative()
+        for i in range(num_points):
+            if point_streams is None:
+                px = transform.uniform(-1, 1, rng)
+                py = transform.uniform(-1, 1, rng)
+            else:
+                px, py = next(starts)
+                start = clock()
+                chosen_indices = streams.choices(point_streams.walk(i, 2, burn_in + iterations), cumulative,
+                                                 self.total_weight).tolist()
+                choose_seconds += clock() - start
+                rng = point_streams.generator(i)
+            r, g, b = 0.0, 0.0, 0.0
+            last = px, py, r, g, b
+
+            for j in range(burn_in + iterations):
+                start = clock()
+                if point_streams is None:
+                    t = self._choose_transform(rng)
+                else:
+                    t = self.transforms[chosen_indices[j]][1]
+                chosen = clock()
+                try:
+                    px, py = t.transform(px, py, rng=rng)
+                except ZeroDivisionError:
+                    px, py = float("inf"), float("inf")
+                r, g, b = t.transform_colour(r, g, b)
+                transformed = clock()
+                index = indices[id(t)]
+                calls[index] += 1
+                seconds[index] += transformed - chosen
+                choose_seconds += chosen - start
+                if not (abs(px) < escape_radius and abs(py) < escape_radius):
+                    px, py, r, g, b = last
+                    continue
+                last = px, py, r, g, b
+                if j < burn_in:
+                    continue
+                fx, fy = self._final_transform(px, py)
+                x = floor((fx + 1) * width / 2)
+                y = floor((fy + 1) * height / 2)
+                projected = clock()
+                image.add_radiance(x, y, [r, g, b])
+                added = clock()
+
+                final_seconds += projected - transformed
+                add_seconds += added - projected
+        image.points += num_points
+
+        for index, (weight, t) in enumerate(self.transforms):
+            profile.add_transform_time(index, t, weight, calls[index], seconds[index])
+        profile.add_phase_time("evaluate/choose transform", choose_seconds)
+        profile.add_phase_time("evaluate/final transform", final_seconds)
+        profile.add_phase_time("evaluate/add radiance", add_seconds)
+        return image
+
+    def _evaluate_seeded(self, image, num_points, iterations, seed, method="scalar", profile=None,
+                         first_point=None, burn_in=0, escape_radius=ESCAPE_RADIUS):
+        ''' evaluate reproducibly from seed. the points are numbered from first_point (by default
+        image.points, the number already evaluated into image) and each draws from its own random
+        stream keyed by its number (see streams.PointStreams). so, up to the rounding of the sums,
+        the image is the same whether the points are evaluated at once or in any batches,
+        checkpoints or worker processes
+        '''
+        first_point = image.points if first_point is None else first_point
+        point_streams = streams.PointStreams(seed, first_point, num_points)
+        options = dict(point_streams=point_streams, burn_in=burn_in, escape_radius=escape_radius)
+        if profile is not None:
+            return self._evaluate_profiled(image, num_points, iterations, profile, method=method, **options)
+        return self._evaluate_engine(image, num_points, iterations, method, **options)
+
+    def evaluate_progressive(self, image, num_points, iterations, batch_points, method="scalar", rng=None,
+                             workers=1, seed=None, preview_path=None, preview_every=1, preview_factor=4,
+                             tolerance=None, profile=None, burn_in=0, escape_radius=ESCAPE_RADIUS):
+        ''' generator version of evaluate that evaluates batch_points at a time and yields
+        (image, points evaluated so far, change) after each batch.
+        with a seed the image is the same as evaluating all the points at once.
+
+        if preview_path is given a tone-mapped preview, preview_factor times smaller than
+        image, is saved there every preview_every batches.
+        change is half the L1 distance between the distributions of samples over the pixels
+        before and after the batch (None when tolerance is not set or on the first batch),
+        evaluation stops early once it drops below tolerance
+        '''
+        previous = None
+        batch = 0
+        remaining = num_points
+        while remaining > 0:
+            points = min(batch_points, remaining)
+            self.evaluate(image, points, iterations, method=method, rng=rng, workers=workers, seed=seed,
+                          profile=profile, burn_in=burn_in, escape_radius=escape_radius)
+            remaining -= points
+            batch += 1
+
+            if preview_path is not None and batch % preview_every == 0:
+                preview = image.downsample(preview_factor)
+                preview.save(preview_path, max(1, (image.points * iterations) / (preview.width * preview.height)))
+
+            change = None
+            if tolerance is not None:
+                distribution = image.counts / max(1, image.counts.sum())
+                if previous is not None:
+                    change = 0.5 * np.abs(distribution - previous).sum()
+                previous = distribution
+            yield image, image.points, change
+            if change is not None and change < tolerance:
+                return
+
+    def _evaluate_checkpointed(self, image, num_points, iterations, checkpoint_path, checkpoint_interval,
+                               method="scalar", rng=None, workers=1, seed=None, profile=None, burn_in=0,
+                               escape_radius=ESCAPE_RADIUS):
+        ''' evaluate in chunks of checkpoint_interval points, writing the image and random state
+        to checkpoint_path after each chunk. rng must be a numpy generator (or None for a fresh one)
+        so its state can be saved with the system, continuing from checkpoint.load gives the same distribution
+        as an uninterrupted run. with a seed continuing gives the same image
+        '''
+        if rng is None:
+            rng = np.random.default_rng()
+        elif not isinstance(rng, np.random.Generator):
+            raise TypeError("checkpointed evaluation needs a numpy Generator, got {}".format(type(rng)))
+        remaining = num_points
+        while remaining > 0:
+            points = min(checkpoint_interval, remaining)
+            if seed is None:
+                # parallel workers get their streams from a seed drawn here, so the saved state covers them too
+                chunk_seed = int(rng.integers(2 ** 63)) if workers != 1 else None
+            else:
+                chunk_seed = seed
+            self.evaluate(image, points, iterations, method=method, rng=rng, workers=workers, seed=chunk_seed,
+                          profile=profile, burn_in=burn_in, escape_radius=escape_radius)
+            remaining -= points
+            with instrument.phase(profile, "checkpoint"):
+                checkpoint.save(checkpoint_path, image, iterations, rng, self)
+        return image
+
+    def evaluate_vectorized(self, image, num_points, iterations, rng=None, profile=None, walkers=None, burn_in=0,
+                            escape_radius=ESCAPE_RADIUS, point_streams=None):
+        ''' the same chaos game as evaluate but all num_points walkers are moved
+        forward together, samples are collected and binned into the image in bulk.
+        rng is an optional numpy random generator, the global numpy state is used if it is not passed.
+        point_streams is an optional streams.PointStreams of the walkers to draw from instead, in a seeded evaluation.
+        profile is an optional instrument.Profile, timings are taken once per batch of walkers.
+        walkers is an optional (px, py, colours) tuple of arrays to start from instead of num_points
+        random points, it is updated in place so a later call can carry on from where this one stopped.
+        the walkers are moved burn_in times before they start being plotted and walkers that
+        diverge beyond escape_radius (or become nan) carry on from their last live positions
+        '''
+        rng = np.random if rng is None else rng
+        table = self.compile()
+        width, height = image.width, image.height
+        if point_streams is not None:
+            px, py = point_streams.start()
+            colours = np.zeros((num_points, 3))
+        elif walkers is None:
+            px = rng.uniform(-1, 1, num_points)
+            py = rng.uniform(-1, 1, num_points)
+            colours = np.zeros((num_points, 3))
+        else:
+            px, py, colours = walkers
+            num_points = len(px)
+
+        last = px.copy(), py.copy(), colours.copy()
+        pending_x, pending_y, pending_colours = [], [], []
+        pending_count = 0
+        for j in range(burn_in + iterations):
+            if point_streams is None:
+                self._step_walkers(px, py, colours, rng, table, profile)
+            else:
+                # a generator of the step is only made for transforms that need one
+                step_rng = None if table is not None else point_streams.generator(0, j)
+                self._step_walkers(px, py, colours, step_rng, table, profile, bits=point_streams.bits(2 + j))
+            alive = self._restore_diverged(px, py, colours, last, escape_radius)
+            if j < burn_in:
+                continue
+
+            with instrument.phase(profile, "evaluate/final transform"):
+                fx, fy = self._final_transform_batch(px, py)
+            fx = (fx + 1) * width / 2
+            fy = (fy + 1) * height / 2
+            finite = alive & np.isfinite(fx) & np.isfinite(fy)
+            # points outside of the image are dropped anyway, limit them so the integer conversion is safe.
+            # floored rather than truncated, so samples just left of or below the image are not drawn on its edge
+            limit = 2 * max(width, height)
+            pending_x.append(np.floor(np.clip(fx[finite], -limit, limit)).astype(np.int64))
+            pending_y.append(np.floor(np.clip(fy[finite], -limit, limit)).astype(np.int64))
+            pending_colours.append(colours[finite])
+            pending_count += num_points
+
+            # binning is done once enough samples are collected to amortize a full pass over the image
+            if pending_count >= min(width * height, MAX_PENDING_SAMPLES) or j == burn_in + iterations - 1:
+                with instrument.phase(profile, "evaluate/add radiance"):
+                    image.add_radiance_batch(np.concatenate(pending_x),
+                                             np.concatenate(pending_y),
+                                             np.concatenate(pending_colours))
+                pending_x, pending_y, pending_colours = [], [], []
+                pending_count = 0
+        image.points += num_points
+        return image
+
+    def iterate_deterministic(self, width, height, max_steps=DETERMINISTIC_STEPS, tolerance=DETERMINISTIC_TOLERANCE,
+                              subsamples=DETERMINISTIC_SUBSAMPLES, refine_steps=DETERMINISTIC_REFINE_STEPS):
+        ''' the deterministic counterpart of the chaos game for systems of affine and linear transforms:
+        starting from subsamples x subsamples points in every pixel of a width x height image of the
+        viewport, apply every transform to every point at once. each point carries the share of the
+        samples the chaos game would put there (mass, passed on in proportion to the weights) and their
+        mean colour, and points that land in the same cell of a grid subsamples times finer than the
+        pixels are merged (see _merge_points). the points are images of images of the starting points,
+        so they converge onto the attractor (also where it leaves the viewport) rather than onto a cover
+        of pixels around it, and their mass to its density.
+        yields (step, mass, colours) after each step, summed over the width * height pixels in image buffer
+        order, until the mass changes by less than tolerance (half the L1 distance) or stalls, see
+        DETERMINISTIC_STALL_STEPS, or after max_steps. then refine_steps more steps merge into cells
+        DETERMINISTIC_REFINEMENT times finer (fewer if that would make more than DETERMINISTIC_MAX_POINTS).
+        every transform has to be a contraction, otherwise the images of the points spread without bound
+        instead of converging
+        '''
+        table = self.compile()
+        if table is None or table.families != [kernel.AFFINE]:
+            raise ValueError("the deterministic method needs a system of only affine and linear transforms")
+        if not all(np.linalg.norm(np.reshape(row[:4], (2, 2)), 2) < 1 for row in table.params):
+            raise ValueError("the deterministic method needs every transform to be a contraction")
+        size = width * height
+        xmin, xmax, ymin, ymax = self.viewport
+        x_scale, y_scale = width / (xmax - xmin), height / (ymax - ymin)
+        kernel.check_total_weight(table.total_weight)
+        shares = table.cumulative / table.total_weight
+        shares = np.diff(shares, prepend=0.0)
+        grid_x, grid_y = np.meshgrid((np.arange(width * subsamples) + 0.5) / subsamples,
+                                     (np.arange(height * subsamples) + 0.5) / subsamples)
+        x = xmin + grid_x.ravel() / x_scale
+        y = ymin + grid_y.ravel() / y_scale
+        mass = np.full(len(x), 1.0 / len(x))
+        colours = np.zeros((len(x), 3))
+        cells = subsamples
+        previous = None
+        changes = []
+        settled_step = None
+        for step in range(1, max_steps + refine_steps + 1):
+            if settled_step is not None and step > settled_step + refine_steps:
+                return
+            points = None
+            # merged after every transform, so there are never many more points than cells they occupy
+            for a, b, c, d, e, f, share, colour in zip(*table.params[:, :6].T, shares, table.colours):
+                if share == 0:
+                    # the chaos game never applies it
+                    continue
+                moved = a * x + b * y + e, c * x + d * y + f, mass * share, (colours + colour) / 2
+                if points is not None:
+                    moved = tuple(np.concatenate(pair) for pair in zip(points, moved))
+                points = _merge_points(*moved, cells, xmin, x_scale, ymin, y_scale)
+            x, y, mass, colours = points
+
+            # rows count down from the top
+            fx = np.floor((x - xmin) * x_scale)
+            fy = np.floor((y - ymin) * y_scale)
+            inside = (fx >= 0) & (fx < width) & (fy >= 0) & (fy < height)
+            pixels = fx[inside].astype(np.int64) + (height - 1 - fy[inside].astype(np.int64)) * width
+            pixel_mass = np.bincount(pixels, weights=mass[inside], minlength=size)
+            occupied = pixel_mass > 0
+            pixel_colours = np.zeros((size, 3))
+            for channel in range(3):
+                pixel_colours[:, channel] = np.bincount(pixels, weights=mass[inside] * colours[inside, channel],
+                                                        minlength=size)
+            pixel_colours[occupied] /= pixel_mass[occupied, None]
+            if previous is not None:
+                changes.append(0.5 * np.abs(pixel_mass - previous).sum())
+            previous = pixel_mass
+            yield step, pixel_mass, pixel_colours
+            # merging moves some mass between pixels on every step, so the change stops falling at some point
+            settled = changes and (changes[-1] < tolerance or (len(changes) > DETERMINISTIC_STALL_STEPS and
+                                   changes[-1] > 0.9 * changes[-1 - DETERMINISTIC_STALL_STEPS]))
+            if settled_step is None and (settled or step == max_steps):
+                settled_step = step
+                refinement = min(DETERMINISTIC_REFINEMENT, int(np.sqrt(DETERMINISTIC_MAX_POINTS / len(x))))
+                cells = subsamples * max(1, refinement)
+
+    def evaluate_deterministic(self, image, num_points, iterations, max_steps=DETERMINISTIC_STEPS,
+                               tolerance=DETERMINISTIC_TOLERANCE, subsamples=DETERMINISTIC_SUBSAMPLES,
+                               refine_steps=DETERMINISTIC_REFINE_STEPS, frame_path=None, profile=None):
+        ''' render the attractor with iterate_deterministic instead of random walkers, adding to image
+        the samples num_points walkers of iterations steps would be expected to leave, so it is tone
+        mapped like a converged chaos game. the cost is bounded by max_steps (and refine_steps) passes
+        over the points whatever the number of samples. every occupied pixel gets at least one sample, however little
+        of the density it has, so thin parts of the attractor are drawn. if frame_path is given, a format string such as
+        "frames/step_{:03d}.png", every step is also saved there as an image of its own
+        '''
+        samples = num_points * iterations
+        mass, colours = None, None
+        with instrument.phase(profile, "evaluate/deterministic"):
+            for step, mass, colours in self.iterate_deterministic(image.width, image.height, max_steps, tolerance,
+                                                                      subsamples, refine_steps):
+                if frame_path is not None:
+                    frame = type(image)(image.width, image.height)
+                    _add_density(frame, mass, colours, samples)
+                    frame.save(frame_path.format(step), max(1, samples / (image.width * image.height)))
+        if mass is not None:
+            _add_density(image, mass, colours, samples)
+        image.points += num_points
+        return image
+
+
+def _sign_bits(count, rng=None):
+    ''' a list of count random booleans from rng, a numpy generator, or the random module if it is None '''
+    if rng is not None:
+        return (rng.random(count) >= 0.5).tolist()
+    return [bit == "1" for bit in format(random.getrandbits(count), "0{}b".format(count))]
+
+
+def _merge_points(x, y, mass, colours, cells, xmin, x_scale, ymin, y_scale):
+    ''' merge the points that are in the same cell of a grid cells times finer than the pixels (see
+    iterate_deterministic) into one with the sum of their mass at their mean position and colour,
+    weighted by mass. affine transforms keep means, so the merged points stay within a cell of the attractor
+    '''
+    cells_x = np.floor((x - xmin) * x_scale * cells)
+    cells_y = np.floor((y - ymin) * y_scale * cells)
+    order = np.lexsort((cells_y, cells_x))
+    cells_x, cells_y = cells_x[order], cells_y[order]
+    starts = np.ones(len(order), dtype=bool)
+    starts[1:] = (cells_x[1:] != cells_x[:-1]) | (cells_y[1:] != cells_y[:-1])
+    groups = np.cumsum(starts) - 1
+    weights = mass[order]
+    merged = np.bincount(groups, weights=weights)
+    # a mass too small to represent leaves the point where it was
+    merged_safe = np.where(merged > 0, merged, 1.0)
+    weights = np.where(merged[groups] > 0, weights, starts.astype(float))
+    means = [np.bincount(groups, weights=weights * values[order]) / merged_safe
+             for values in (x, y, colours[:, 0], colours[:, 1], colours[:, 2])]
+    return means[0], means[1], merged, np.column_stack(means[2:])
+
+
+def _add_density(image, mass, colours, samples):
+    ''' add samples spread over the pixels in proportion to mass, with the colours of the pixels.
+    rounding would leave out the pixels with less than half a sample, they get one
+    '''
+    counts = np.maximum(np.rint(mass * samples), mass > 0).astype(np.int64)
+    image.counts += counts
+    image.data += (colours * counts[:, None]).astype(image.data.dtype).ravel()
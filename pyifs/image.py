@@ -1,8 +1,10 @@
-from array import array
-from math import log10
 import struct
 import zlib
 
+import numpy as np
+
+from .instrument import phase
+
 
 # how much each channel contributes to luminance
 RGB_LUMINANCE = (0.2126, 0.7152, 0.0722)
@@ -14,21 +16,77 @@ SCALEFACTOR_NUMERATOR = 1.219 + (DISPLAY_LUMINANCE_MAX * 0.25) ** 0.4
 
 GAMMA_ENCODE = 0.45
 
+# roughly how many pixels are in each tile, the image is processed one tile at a time
+TILE_PIXELS = 1 << 20
+
 class Image(object):
 
-    def __init__(self, width, height):
+    def __init__(self, width, height, dtype=np.float64, path=None, tile_rows=None):
         """
-        initialize blank image.
+        initialize blank image. dtype is the type of the radiance buffer,
+        float32 halves the memory of large images at the cost of precision.
+
+        if path is given the radiance buffer is kept in a memory-mapped file
+        there (and the sample counts in path + ".counts") instead of in memory.
+        the image is split into tiles of tile_rows full rows, which are contiguous
+        in the buffer, points are binned and the image is saved one tile at a time.
         """
         self.width = width
         self.height = height
-        self.data = array("d", [0]) * (width * height * 3)
+        self.path = path
+        self.tile_rows = tile_rows or max(1, TILE_PIXELS // width)
+        # number of points evaluated into the image
+        self.points = 0
+        if path is None:
+            self.data = np.zeros(width * height * 3, dtype=dtype)
+            # number of samples that landed in each pixel
+            self.counts = np.zeros(width * height, dtype=np.int64)
+        else:
+            self.data = np.memmap(path, dtype=dtype, mode="w+", shape=(width * height * 3,))
+            self.counts = np.memmap(path + ".counts", dtype=np.int64, mode="w+", shape=(width * height,))
+
+    def __getstate__(self):
+        """
+        a memory-mapped image is pickled as its files, which are flushed first, rather than its contents,
+        so it is passed between processes without being copied into memory.
+        """
+        state = dict(vars(self))
+        if self.path is not None:
+            self.flush()
+            state["data"] = self.data.dtype
+            del state["counts"]
+        return state
+
+    def __setstate__(self, state):
+        vars(self).update(state)
+        if self.path is not None:
+            size = self.width * self.height
+            self.data = np.memmap(self.path, dtype=state["data"], mode="r+", shape=(size * 3,))
+            self.counts = np.memmap(self.path + ".counts", dtype=np.int64, mode="r+", shape=(size,))
+
+    def tiles(self):
+        """
+        iterate over the tiles of the image as (first row, last row + 1) in buffer order, top row first.
+        """
+        for start in range(0, self.height, self.tile_rows):
+            yield start, min(self.height, start + self.tile_rows)
+
+    def flush(self):
+        """
+        write a memory-mapped buffer out to its file.
+        """
+        if self.path is not None:
+            self.data.flush()
+            self.counts.flush()
+
+    def _pixel(self, x, y):
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            raise IndexError("pixel ({}, {}) is outside of the {}x{} image".format(x, y, self.width, self.height))
+        return x + (self.height - 1 - y) * self.width
 
     def _index(self, t):
         x, y, channel = t
-        index = (x + ((self.height - 1 - y) * self.width)) * 3 + channel
-
-        return min(max(index, 0), len(self.data) - 1)
+        return self._pixel(x, y) * 3 + channel
 
     def __getitem__(self, t):
         return self.data[self._index(t)]
@@ -38,11 +96,136 @@ class Image(object):
 
     def add_radiance(self, x, y, radiance):
         """
-        add radiance (an RGB tuple) to given x, y position on image.
+        add radiance (an RGB tuple) to given x, y position on image,
+        points outside of the image are dropped.
+        """
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            return
+        pixel = self._pixel(x, y)
+        index = pixel * 3
+        self.data[index] += radiance[0]
+        self.data[index + 1] += radiance[1]
+        self.data[index + 2] += radiance[2]
+        self.counts[pixel] += 1
+
+    def add_radiance_batch(self, xs, ys, rgb):
+        """
+        add radiance for many points at once. xs and ys are integer arrays of
+        positions and rgb is an (n, 3) array of colours, points outside of the
+        image are dropped.
+        """
+        inside = (xs >= 0) & (xs < self.width) & (ys >= 0) & (ys < self.height)
+        pixels = xs[inside] + (self.height - 1 - ys[inside]) * self.width
+        rgb = rgb[inside]
+        tile_size = self.tile_rows * self.width
+        if tile_size >= self.width * self.height:
+            self._bin(0, pixels, rgb)
+            return
+
+        # group the points by tile so each tile of the buffer is written in one go
+        tiles = pixels // tile_size
+        order = np.argsort(tiles, kind="stable")
+        pixels, tiles, rgb = pixels[order], tiles[order], rgb[order]
+        tile_count = -(-self.height // self.tile_rows)
+        bounds = np.searchsorted(tiles, np.arange(tile_count + 1))
+        for tile in np.flatnonzero(np.diff(bounds)):
+            start, stop = bounds[tile], bounds[tile + 1]
+            self._bin(tile * tile_size, pixels[start:stop], rgb[start:stop])
+
+    def _bin(self, offset, pixels, rgb):
+        """
+        add radiance to the tile starting at pixel offset, pixels are absolute pixel indices in that tile.
+        """
+        size = min(self.tile_rows * self.width, self.width * self.height - offset)
+        channels = self.data[offset * 3:(offset + size) * 3].reshape(size, 3)
+        counts = self.counts[offset:offset + size]
+        pixels = pixels - offset
+        if len(pixels) * 8 < size:
+            # a few points in a large tile, adding them one by one beats a pass over the whole tile
+            for channel in range(3):
+                np.add.at(channels[:, channel], pixels, rgb[:, channel])
+            np.add.at(counts, pixels, 1)
+        else:
+            for channel in range(3):
+                channels[:, channel] += np.bincount(pixels, weights=rgb[:, channel], minlength=size)
+            counts += np.bincount(pixels, minlength=size)
+
+    def add_image(self, other):
+        """
+        add the radiance, sample counts and points of another image of the same size to this one.
         """
-        self[x, y, 0] += radiance[0]
-        self[x, y, 1] += radiance[1]
-        self[x, y, 2] += radiance[2]
+        if (other.width, other.height) != (self.width, self.height):
+            raise ValueError("cannot add a {}x{} image to a {}x{} image".format(other.width, other.height,
+                                                                             self.width, self.height))
+        for start, stop in self.tiles():
+            self.data[start * self.width * 3:stop * self.width * 3] += other.data[start * self.width * 3:stop * self.width * 3]
+            self.counts[start * self.width:stop * self.width] += other.counts[start * self.width:stop * self.width]
+        self.points += other.points
+
+    def downsample(self, factor, filter="box"):
+        """
+        return a new image factor times smaller in each direction, rows and columns
+        that do not fill a whole block are dropped. with the "box" filter each pixel
+        is the sum of a factor x factor block of this image. the "gaussian" filter
+        spreads every pixel over its neighbouring blocks too, which smooths the
+        edges more, its sample counts are fractional.
+        """
+        if filter == "gaussian":
+            return self._downsample_gaussian(factor)
+        elif filter != "box":
+            raise ValueError("unknown filter: {}".format(filter))
+        small = Image(self.width // factor, self.height // factor, dtype=self.data.dtype)
+        small.points = self.points
+        width = small.width * factor
+        step = max(1, self.tile_rows // factor) * factor
+        for start in range(0, small.height * factor, step):
+            stop = min(small.height * factor, start + step)
+            blocks = (stop - start) // factor
+            data = self.data[start * self.width * 3:stop * self.width * 3].reshape(-1, self.width, 3)[:, :width]
+            small.data[start // factor * small.width * 3:stop // factor * small.width * 3] = \
+                data.reshape(blocks, factor, small.width, factor, 3).sum(axis=(1, 3)).ravel()
+            counts = self.counts[start * self.width:stop * self.width].reshape(-1, self.width)[:, :width]
+            small.counts[start // factor * small.width:stop // factor * small.width] = \
+                counts.reshape(blocks, factor, small.width, factor).sum(axis=(1, 3)).ravel()
+        return small
+
+    def _downsample_gaussian(self, factor):
+        width, height = self.width // factor, self.height // factor
+        taps = gaussian_taps(factor)
+        radius = (len(taps) - factor) // 2
+
+        def filtered(values, length, axis):
+            # sum the taps over the strided slices of values, padded by radius, one output per block
+            total = 0
+            for t, weight in enumerate(taps):
+                index = [slice(None)] * values.ndim
+                index[axis] = slice(t, t + length * factor, factor)
+                total = total + weight * values[tuple(index)]
+            return total
+
+        def padded(values, before, after, axis):
+            padding = [(0, 0)] * values.ndim
+            padding[axis] = (before, after)
+            return np.pad(values, padding)
+
+        small = Image(width, height, dtype=self.data.dtype)
+        small.points = self.points
+        small.counts = np.zeros(width * height)
+        # a tile of output rows at a time, each reading its rows of this image with radius rows either side
+        step = max(1, self.tile_rows // factor)
+        for first in range(0, height, step):
+            last = min(height, first + step)
+            start, stop = first * factor - radius, last * factor + radius
+            low, high = max(0, start), min(height * factor, stop)
+            data = self.data[low * self.width * 3:high * self.width * 3].reshape(-1, self.width, 3)
+            data = padded(data[:, :width * factor], low - start, stop - high, 0)
+            data = padded(filtered(data, last - first, 0), radius, radius, 1)
+            small.data[first * width * 3:last * width * 3] = filtered(data, width, 1).ravel()
+            counts = self.counts[low * self.width:high * self.width].reshape(-1, self.width)
+            counts = padded(counts[:, :width * factor].astype(np.float64), low - start, stop - high, 0)
+            counts = padded(filtered(counts, last - first, 0), radius, radius, 1)
+            small.counts[first * width:last * width] = filtered(counts, width, 1).ravel()
+        return small
 
     def calculate_scalefactor(self, iterations):
         """
@@ -52,15 +235,9 @@ class Image(object):
         ## calculate the log-mean luminance of the image
 
         sum_of_logs = 0.0
-
-        for x in range(self.width):
-            for y in range(self.height):
-                lum = self[x, y, 0] * RGB_LUMINANCE[0]
-                lum += self[x, y, 1] * RGB_LUMINANCE[1]
-                lum += self[x, y, 2] * RGB_LUMINANCE[2]
-                lum /= iterations
-
-                sum_of_logs += log10(max(lum, 0.0001))
+        for start, stop in self.tiles():
+            lum = self._tile_data(start, stop).reshape(-1, 3).dot(RGB_LUMINANCE) / iterations
+            sum_of_logs += np.log10(np.maximum(lum, 0.0001)).sum()
 
         log_mean_luminance = 10.0 ** (sum_of_logs / (self.height * self.width))
 
@@ -74,37 +251,127 @@ class Image(object):
 
         return scalefactor
 
-    def display_pixels(self, iterations):
+    def _tile_data(self, start, stop):
+        return self.data[start * self.width * 3:stop * self.width * 3]
+
+    def _tile_counts(self, start, stop):
+        return self.counts[start * self.width:stop * self.width]
+
+    def display_array(self, iterations, tone_map=None):
+        """
+        return the gamma-corrected image scaled 0 - 1 (although not clipped to 1)
+        as a (height, width, 3) array, top row first. tone_map is a WardToneMap
+        (the default) or LogDensityToneMap.
+        """
+        tone_map = tone_map or WardToneMap()
+        scale = tone_map.scale(self, iterations)
+        return np.concatenate([tone_map.display_tile(self, start, stop, scale) for start, stop in self.tiles()])
+
+    def display_pixels(self, iterations, tone_map=None):
         """
         iterate over each channel of each pixel in image returning
         gamma-corrected number scaled 0 - 1 (although not clipped to 1).
         """
-        scalefactor = self.calculate_scalefactor(iterations)
-
-        for value in self.data:
-            yield max(value * scalefactor / iterations, 0) ** GAMMA_ENCODE
+        tone_map = tone_map or WardToneMap()
+        scale = tone_map.scale(self, iterations)
+        for start, stop in self.tiles():
+            for value in tone_map.display_tile(self, start, stop, scale).ravel():
+                yield float(value)
 
-    def save(self, filename, iterations):
+    def save(self, filename, iterations, compression=6, profile=None, tone_map=None, supersample=1, filter="box"):
         """
         save the image to given filename assuming the given number
-        of iterations.
+        of iterations. compression is the zlib level from 0 (none, fastest) to 9.
+        the image is tone-mapped and compressed one tile at a time.
+        profile is an optional instrument.Profile timing the tone-map and encode phases.
+        tone_map is a WardToneMap (the default) or LogDensityToneMap.
+        if the image was accumulated supersample times larger than the output in each direction
+        it is first downsampled with filter, "box" or "gaussian", see downsample.
         """
+        if supersample > 1:
+            with phase(profile, "downsample"):
+                small = self.downsample(supersample, filter)
+            return small.save(filename, iterations * supersample ** 2, compression=compression, profile=profile,
+                              tone_map=tone_map)
+        tone_map = tone_map or WardToneMap()
+        with phase(profile, "tone-map"):
+            scale = tone_map.scale(self, iterations)
+        compressor = zlib.compressobj(compression)
 
         with open(filename, "wb") as f:
             f.write(struct.pack("8B", 137, 80, 78, 71, 13, 10, 26, 10))
-            output_chunk(f, "IHDR", struct.pack("!2I5B", self.width, self.height, 8, 2, 0, 0, 0))
-            compressor = zlib.compressobj()
-            data = array("B")
-            pixels = self.display_pixels(iterations)
-            for y in range(self.height):
-                data.append(0)
-                for x in range(self.width):
-                    for channel in range(3):
-                        data.append(min(255, max(0, int(pixels.next() * 255.0 + 0.5))))
-            compressed = compressor.compress(data.tostring())
-            flushed = compressor.flush()
-            output_chunk(f, "IDAT", compressed + flushed)
-            output_chunk(f, "IEND", "")
+            output_chunk(f, b"IHDR", struct.pack("!2I5B", self.width, self.height, 8, 2, 0, 0, 0))
+            for start, stop in self.tiles():
+                with phase(profile, "tone-map"):
+                    pixels = tone_map.display_tile(self, start, stop, scale)
+                with phase(profile, "encode"):
+                    # each row of a png starts with its filter type, 0 for none
+                    rows = np.zeros((stop - start, self.width * 3 + 1), dtype=np.uint8)
+                    rows[:, 1:] = np.clip(np.floor(pixels * 255.0 + 0.5), 0, 255).reshape(stop - start, -1)
+                    compressed = compressor.compress(rows.tobytes())
+                    if compressed:
+                        output_chunk(f, b"IDAT", compressed)
+            with phase(profile, "encode"):
+                output_chunk(f, b"IDAT", compressor.flush())
+                output_chunk(f, b"IEND", b"")
+
+
+class WardToneMap(object):
+    """
+    linear tone mapping of the radiance with one scalefactor for the whole image,
+    from its log-mean luminance, followed by gamma encoding.
+    """
+
+    def scale(self, image, iterations):
+        return image.calculate_scalefactor(iterations) / iterations
+
+    def display_tile(self, image, start, stop, scale):
+        values = image._tile_data(start, stop) * scale
+        return (np.maximum(values, 0) ** GAMMA_ENCODE).reshape(stop - start, image.width, 3)
+
+
+class LogDensityToneMap(object):
+    """
+    tone mapping in the style of fractal flames. each pixel gets the mean colour of
+    its samples, with an alpha that grows with the log of its density, its number of
+    samples over iterations (the average number per pixel), relative to the densest
+    pixel and times brightness. so sparse regions of the attractor show up after far
+    fewer points than with one linear scalefactor.
+    vibrancy goes from 0, applying gamma to every channel, to 1, applying it to
+    alpha only which keeps the colours saturated in dim regions.
+    """
+
+    def __init__(self, gamma=2.2, vibrancy=1.0, brightness=1.0):
+        self.gamma = gamma
+        self.vibrancy = vibrancy
+        self.brightness = brightness
+
+    def scale(self, image, iterations):
+        densest = max(float(image._tile_counts(start, stop).max()) for start, stop in image.tiles())
+        return iterations, self.brightness / np.log1p(max(densest, 1.0) / iterations)
+
+    def display_tile(self, image, start, stop, scale):
+        iterations, brightness = scale
+        counts = np.asarray(image._tile_counts(start, stop), dtype=np.float64)
+        colour = np.maximum(image._tile_data(start, stop).reshape(-1, 3) / np.maximum(counts, 1)[:, None], 0)
+        alpha = np.minimum(np.log1p(counts / iterations) * brightness, 1.0)[:, None]
+        pixels = (self.vibrancy * colour * alpha ** (1 / self.gamma) +
+                  (1 - self.vibrancy) * (colour * alpha) ** (1 / self.gamma))
+        return pixels.reshape(stop - start, image.width, 3)
+
+
+def gaussian_taps(factor, sigma=None):
+    """
+    the weights of the gaussian filter that downsamples by factor, over factor plus a
+    radius on both sides input pixels for each output pixel. sigma, in input pixels,
+    is half of factor by default. the weights sum to factor, so on average every input
+    pixel contributes its whole radiance to the output.
+    """
+    sigma = sigma or 0.5 * factor
+    radius = int(np.ceil(2 * sigma))
+    centres = np.arange(-radius, factor + radius) + 0.5
+    taps = np.exp(-0.5 * ((centres - 0.5 * factor) / sigma) ** 2)
+    return taps * (factor / taps.sum())
 
 
 def output_chunk(f, chunk_type, data):
@@ -112,4 +379,4 @@ def output_chunk(f, chunk_type, data):
     f.write(chunk_type)
     f.write(data)
     checksum = zlib.crc32(data, zlib.crc32(chunk_type))
-    f.write(struct.pack("!i", checksum))
+    f.write(struct.pack("!I", checksum & 0xffffffff))
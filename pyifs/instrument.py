@@ -0,0 +1,71 @@
+from contextlib import contextmanager, nullcontext
+import json
+import time
+
+
+class Profile:
+    ''' timings and counters collected from an instrumented evaluation, pass one to IFS.evaluate and Image.save '''
+
+    def __init__(self):
+        self.phases = dict()
+        # per transform index: [description, weight, calls, seconds]
+        self.transforms = dict()
+        self.samples = 0
+        self.inside = 0
+
+    @contextmanager
+    def phase(self, name):
+        ''' time the body of the with statement, adding it to the named phase '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_phase_time(name, time.perf_counter() - start)
+
+    def add_phase_time(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def add_transform_time(self, index, transform, weight, calls, seconds=None):
+        ''' record that transform (index in the system) was applied calls times taking seconds,
+        or None when the engine counts the calls without timing them, as the jit engine does
+        '''
+        entry = self.transforms.setdefault(index, [str(transform), weight, 0, None])
+        entry[2] += calls
+        if seconds is not None:
+            entry[3] = (entry[3] or 0.0) + seconds
+
+    def add_samples(self, samples, inside):
+        ''' record that samples were plotted of which inside landed in a pixel of the image '''
+        self.samples += samples
+        self.inside += inside
+
+    def merge(self, other):
+        ''' add the timings and counters of another profile, e.g. from a worker process '''
+        for name, seconds in other.phases.items():
+            self.add_phase_time(name, seconds)
+        for index, (description, weight, calls, seconds) in other.transforms.items():
+            self.add_transform_time(index, description, weight, calls, seconds)
+        self.samples += other.samples
+        self.inside += other.inside
+
+    def report(self):
+        ''' the collected profile as a json serializable dictionary '''
+        transforms = [{"index": index, "transform": description, "weight": weight,
+                       "calls": calls, "seconds": seconds,
+                       "seconds_per_call": seconds / calls if calls and seconds is not None else None}
+                      for index, (description, weight, calls, seconds) in sorted(self.transforms.items())]
+        return {"phases": self.phases,
+                "transforms": transforms,
+                "samples": self.samples,
+                "inside": self.inside,
+                "hit_rate": self.inside / self.samples if self.samples else None,
+                "out_of_bounds_rate": 1 - self.inside / self.samples if self.samples else None}
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=2)
+
+
+def phase(profile, name):
+    ''' profile.phase(name) or a context that does nothing when profile is None '''
+    return nullcontext() if profile is None else profile.phase(name)
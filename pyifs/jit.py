@@ -0,0 +1,181 @@
+import os
+import numpy as np
+from . import instrument
+from . import kernel
+from . import streams
+
+try:
+    import numba
+except ImportError:  # numba is optional, the "jit" method falls back to the vectorized engine without it
+    numba = None
+
+# the threading layers numba tries in turn, as it was configured before any evaluation
+_DEFAULT_PRIORITY = None if numba is None else list(numba.config.THREADING_LAYER_PRIORITY)
+
+# the most samples the jit engine stores between passes that add them to the image
+JIT_PENDING_SAMPLES = 1 << 20
+
+# constants of splitmix64, the generator each walker carries so the samples do not depend on the threads
+_GOLDEN, _MIX_1, _MIX_2 = streams.GOLDEN, streams.MIX_1, streams.MIX_2
+
+
+def _prefer_fork_safe_threads():
+    ''' put tbb last among the threading layers before the first parallel kernel runs, which picks the layer
+    of the process: a process that has run tbb threads hangs on exit once it forks, as the worker pools do.
+    a layer chosen through the environment or numba.config is left alone
+    '''
+    if {"NUMBA_THREADING_LAYER", "NUMBA_THREADING_LAYER_PRIORITY"} & set(os.environ):
+        return
+    if numba.config.THREADING_LAYER_PRIORITY == _DEFAULT_PRIORITY:
+        numba.config.THREADING_LAYER_PRIORITY = ["omp", "workqueue", "tbb"]
+
+
+def available():
+    ''' whether numba is installed, so the "jit" method compiles the chaos game '''
+    return numba is not None
+
+
+if numba is not None:
+    @numba.njit(cache=True)
+    def _next_bits(state):
+        ''' advance a splitmix64 state, returning it and 64 random bits '''
+        state = state + _GOLDEN
+        z = state
+        z = (z ^ (z >> np.uint64(30))) * _MIX_1
+        z = (z ^ (z >> np.uint64(27))) * _MIX_2
+        return state, z ^ (z >> np.uint64(31))
+
+    _complex_sqrt = numba.njit(cache=True)(kernel.complex_sqrt)
+
+    @numba.njit(parallel=True, cache=True, error_model="numpy")
+    def _walk(px, py, colours, states, kinds, params, table_colours, cumulative, total_weight,
+              first_step, steps, burn_in, escape_radius, xmin, x_scale, ymin, y_scale, width, height,
+              pixels, samples, calls):
+        ''' move every walker steps times through the compiled table, each on its own thread
+        and random state, writing the pixel (or -1) and colour of every sample to the first
+        steps columns of pixels and samples. calls is a walkers by transforms array of the steps
+        each walker took with each transform, added to when it has a row for every walker
+        '''
+        last_index = len(cumulative) - 1
+        counting = calls.shape[0] > 0
+        for w in numba.prange(len(px)):
+            x, y = px[w], py[w]
+            r, g, b = colours[w, 0], colours[w, 1], colours[w, 2]
+            last_x, last_y, last_r, last_g, last_b = x, y, r, g, b
+            state = states[w]
+            for j in range(steps):
+                pixels[w, j] = -1
+                # the top 53 bits choose the transform, the lowest the branch of an inverse Julia transform
+                state, bits = _next_bits(state)
+                target = (bits >> np.uint64(11)) * (1.0 / 9007199254740992.0) * total_weight
+                index = 0
+                while index < last_index and cumulative[index] <= target:
+                    index += 1
+                if counting:
+                    calls[w, index] += 1
+                p = params[index]
+                kind = kinds[index]
+                if kind == 0:
+                    x, y = p[0] * x + p[1] * y + p[4], p[2] * x + p[3] * y + p[5]
+                elif kind == 1:
+                    nr = p[0] * x - p[1] * y + p[2]
+                    ni = p[0] * y + p[1] * x + p[3]
+                    dr = p[4] * x - p[5] * y + p[6]
+                    di = p[4] * y + p[5] * x + p[7]
+                    scale = 1.0 / (dr * dr + di * di)
+                    x, y = (nr * dr + ni * di) * scale, (ni * dr - nr * di) * scale
+                else:
+                    x, y = _complex_sqrt(p[0] - x, p[1] - y)
+                    if bits & np.uint64(1):
+                        x, y = -x, -y
+                r = (table_colours[index, 0] + r) * 0.5
+                g = (table_colours[index, 1] + g) * 0.5
+                b = (table_colours[index, 2] + b) * 0.5
+
+                if not (abs(x) < escape_radius and abs(y) < escape_radius):
+                    # diverged, carry on from the last live position instead
+                    x, y, r, g, b = last_x, last_y, last_r, last_g, last_b
+                    continue
+                last_x, last_y, last_r, last_g, last_b = x, y, r, g, b
+                if first_step + j < burn_in:
+                    continue
+                fx = (x - xmin) * x_scale
+                fy = (y - ymin) * y_scale
+                # only samples inside the image, where truncating towards zero is the floor
+                if 0.0 <= fx < width and 0.0 <= fy < height:
+                    pixels[w, j] = int(fx) + (height - 1 - int(fy)) * width
+                    samples[w, j, 0] = r
+                    samples[w, j, 1] = g
+                    samples[w, j, 2] = b
+            px[w], py[w] = x, y
+            colours[w, 0], colours[w, 1], colours[w, 2] = r, g, b
+            states[w] = state
+
+    @numba.njit(cache=True)
+    def _bin(pixels, samples, steps, data, counts):
+        ''' add the samples of the first steps columns straight into the flat radiance and count
+        buffers of an image, in a fixed order
+        '''
+        for w in range(pixels.shape[0]):
+            for j in range(steps):
+                pixel = pixels[w, j]
+                if pixel >= 0:
+                    data[3 * pixel] += samples[w, j, 0]
+                    data[3 * pixel + 1] += samples[w, j, 1]
+                    data[3 * pixel + 2] += samples[w, j, 2]
+                    counts[pixel] += 1
+
+
+def evaluate_jit(ifs, image, num_points, iterations, escape_radius, rng=None, profile=None, burn_in=0,
+                 point_streams=None):
+    ''' the chaos game of IFS.evaluate compiled with numba, the walkers are moved on all threads.
+    each walker has its own random state seeded from rng (a numpy generator, a fresh one if
+    it is not passed), so the image only depends on rng and not on the number of threads.
+    in a seeded evaluation the walkers carry on the streams of point_streams (a streams.PointStreams) instead.
+    like the scalar method a walker that diverges beyond escape_radius carries on from its last live position.
+    without numba, or for systems that cannot be compiled (see IFS.compile), the vectorized
+    engine is used instead with the same options
+    '''
+    table = ifs.compile()
+    if numba is None or table is None:
+        return ifs.evaluate_vectorized(image, num_points, iterations, rng=rng, profile=profile, burn_in=burn_in,
+                                       escape_radius=escape_radius, point_streams=point_streams)
+    kernel.check_total_weight(table.total_weight)
+    _prefer_fork_safe_threads()
+    if point_streams is None:
+        rng = np.random.default_rng() if rng is None else rng
+        px = rng.uniform(-1, 1, num_points)
+        py = rng.uniform(-1, 1, num_points)
+        states = rng.integers(0, 2 ** 63, num_points, dtype=np.int64).astype(np.uint64)
+    else:
+        px, py = point_streams.start()
+        # past the two draws of the starting point
+        states = point_streams.advanced(2)
+    colours = np.zeros((num_points, 3))
+
+    xmin, xmax, ymin, ymax = ifs.viewport
+    width, height = image.width, image.height
+    data, counts = np.asarray(image.data), np.asarray(image.counts)
+    total_steps = burn_in + iterations
+    steps = max(1, min(total_steps, JIT_PENDING_SAMPLES // max(1, num_points)))
+    pixels = np.empty((num_points, steps), dtype=np.int64)
+    samples = np.empty((num_points, steps, 3))
+    # with a profile the steps of every walker with every transform are counted, so no two threads add to a count
+    calls = np.zeros((num_points if profile is not None else 0, len(table.kinds)), dtype=np.int64)
+    # the whole buffers are passed with the number of steps used, slices of them would compile again
+    for first_step in range(0, total_steps, steps):
+        count = min(steps, total_steps - first_step)
+        with instrument.phase(profile, "evaluate/walk"):
+            _walk(px, py, colours, states, table.kinds, table.params, table.colours, table.cumulative,
+                  table.total_weight, first_step, count, burn_in, escape_radius,
+                  xmin, width / (xmax - xmin), ymin, height / (ymax - ymin), width, height, pixels, samples,
+                  calls)
+        if first_step + count > burn_in:
+            with instrument.phase(profile, "evaluate/add radiance"):
+                _bin(pixels, samples, count, data, counts)
+    if profile is not None:
+        # the steps are fused into the walk, so the transforms are counted but not timed
+        for index, ((weight, t), transform_calls) in enumerate(zip(ifs.transforms, calls.sum(axis=0).tolist())):
+            profile.add_transform_time(index, t, weight, transform_calls)
+    image.points += num_points
+    return image
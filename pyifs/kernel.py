@@ -0,0 +1,177 @@
+from math import copysign, sqrt
+import random
+import time
+import numpy as np
+
+# the families of transforms the kernel evaluates, with the parameters of each in the table
+AFFINE = 0         # x' = a x + b y + e, y' = c x + d y + f: a, b, c, d, e, f
+MOEBIUS = 1        # z' = (a z + b) / (c z + d): real and imaginary parts of a, b, c, d
+INVERSE_JULIA = 2  # z' = +-sqrt(c - z): real and imaginary parts of c
+PARAMETERS = 8
+
+
+def complex_sqrt(zr, zi):
+    ''' the principal square root of zr + i zi in real arithmetic, without any trigonometry.
+    the larger part comes from a square root and the other from dividing zi by it, so nothing
+    cancels when zr is large. the imaginary part takes the sign of zi, as it does with atan2.
+    the jit engine compiles it with numba and Table.step has it written out
+    '''
+    m = sqrt(zr * zr + zi * zi)
+    if zr >= 0:
+        root_r = sqrt((m + zr) * 0.5)
+        return root_r, (zi / (2 * root_r) if root_r > 0 else zi)
+    root_i = sqrt((m - zr) * 0.5)
+    return abs(zi) / (2 * root_i), copysign(root_i, zi)
+
+
+def check_total_weight(total_weight):
+    ''' raise a ValueError if the weights of a system add up to nothing, when no transform can be chosen '''
+    if not total_weight > 0:
+        raise ValueError("the weights of the transforms add up to {}, no transform can be chosen".format(total_weight))
+
+
+class Table:
+    ''' an iterated function system compiled into flat arrays: the family, parameters, colour
+    and running total of the weights of every transform. step and step_batch advance walkers
+    through it without calling any methods of the transforms
+    '''
+
+    def __init__(self, kinds, params, colours, weights):
+        self.kinds = np.array(kinds, dtype=np.int64)
+        self.params = np.zeros((len(kinds), PARAMETERS))
+        for row, values in zip(self.params, params):
+            row[:len(values)] = values
+        self.colours = np.array(colours, dtype=float).reshape(len(kinds), 3)
+        self.cumulative = np.cumsum(weights, dtype=float)
+        self.total_weight = float(self.cumulative[-1]) if len(kinds) else 0.0
+        self.families = sorted(set(self.kinds.tolist()))
+        # python copies for the scalar step, indexing lists of floats is much faster than numpy arrays
+        self.rows = [(kind, tuple(row)) for kind, row in zip(self.kinds.tolist(), self.params.tolist())]
+        self.colour_rows = [tuple(colour) for colour in self.colours.tolist()]
+
+    def choose_indices(self, count, rng=None):
+        ''' choose count transform indices using the weighting '''
+        check_total_weight(self.total_weight)
+        rng = np.random if rng is None else rng
+        w = rng.random(count) * self.total_weight
+        # the product can round up to the total, which would be past the last transform
+        return np.minimum(np.searchsorted(self.cumulative, w, side="right"), len(self.kinds) - 1)
+
+    def step(self, index, px, py, r, g, b, negate=None, rng=None):
+        ''' move one walker at px, py with colour r, g, b by transform index, returning the new
+        px, py, r, g, b. negate is the branch of the square root of inverse Julia transforms,
+        usually drawn in bulk beforehand, if it is None it is drawn from rng (a numpy generator)
+        or the random module if that is not passed either
+        '''
+        kind, p = self.rows[index]
+        if kind == AFFINE:
+            px, py = p[0] * px + p[1] * py + p[4], p[2] * px + p[3] * py + p[5]
+        elif kind == MOEBIUS:
+            # (a z + b) / (c z + d) written out in real arithmetic, so no complex numbers are made
+            nr = p[0] * px - p[1] * py + p[2]
+            ni = p[0] * py + p[1] * px + p[3]
+            dr = p[4] * px - p[5] * py + p[6]
+            di = p[4] * py + p[5] * px + p[7]
+            scale = 1.0 / (dr * dr + di * di)
+            px, py = (nr * dr + ni * di) * scale, (ni * dr - nr * di) * scale
+        else:
+            # complex_sqrt written out, a call costs as much as the arithmetic
+            zr = p[0] - px
+            zi = p[1] - py
+            m = sqrt(zr * zr + zi * zi)
+            if zr >= 0:
+                px = sqrt((m + zr) * 0.5)
+                py = zi / (2 * px) if px > 0 else zi
+            else:
+                py = copysign(sqrt((m - zr) * 0.5), zi)
+                px = abs(zi) / (2 * abs(py))
+            if negate is None:
+                negate = (random.random() if rng is None else rng.random()) >= 0.5
+            if negate:
+                px, py = -px, -py
+        cr, cg, cb = self.colour_rows[index]
+        return px, py, (cr + r) * 0.5, (cg + g) * 0.5, (cb + b) * 0.5
+
+    def step_batch(self, px, py, colours, choices, rng=None, negate=None, seconds=None):
+        ''' move the walkers at numpy arrays px, py with colours (n x 3) by the transforms of the
+        indices choices, in place. every family is evaluated once over all of its walkers with
+        the parameters gathered from the table, rather than once per transform.
+        negate is an optional boolean array of the branches of inverse Julia transforms, if it is
+        None they are drawn from rng (a numpy generator, the global numpy state if it is not passed).
+        seconds is an optional list with an entry per transform, to profile them the transforms are
+        evaluated one at a time instead and the time each takes is added to its entry
+        '''
+        if negate is None and INVERSE_JULIA in self.families:
+            negate = (np.random if rng is None else rng).random(len(px)) >= 0.5
+        if seconds is not None:
+            for index, kind in enumerate(self.kinds.tolist()):
+                start = time.perf_counter()
+                selected = np.flatnonzero(choices == index)
+                if len(selected):
+                    self._step_family(kind, px, py, self.params[index][:, None], selected, negate)
+                seconds[index] += time.perf_counter() - start
+        elif len(self.families) == 1:
+            self._step_family(self.families[0], px, py, self.params[choices].T, None, negate)
+        else:
+            p = self.params[choices].T
+            kinds = self.kinds[choices]
+            for kind in self.families:
+                selected = np.flatnonzero(kinds == kind)
+                self._step_family(kind, px, py, p[:, selected], selected, negate)
+        colours += self.colours[choices]
+        colours *= 0.5
+
+    @staticmethod
+    def _step_family(kind, px, py, p, selected, negate):
+        ''' apply the transforms of one family to the walkers selected (all if None), in place.
+        p holds the parameters of the selected walkers, or of one transform for all of them
+        '''
+        x, y = (px, py) if selected is None else (px[selected], py[selected])
+        if selected is not None and negate is not None:
+            negate = negate[selected]
+        if kind == AFFINE:
+            x, y = p[0] * x + p[1] * y + p[4], p[2] * x + p[3] * y + p[5]
+        elif kind == MOEBIUS:
+            z = x + 1j * y
+            # points on the pole become inf or nan and are treated as diverged
+            with np.errstate(divide="ignore", invalid="ignore"):
+                z = ((p[0] + 1j * p[1]) * z + (p[2] + 1j * p[3])) / ((p[4] + 1j * p[5]) * z + (p[6] + 1j * p[7]))
+            x, y = z.real, z.imag
+        else:
+            root = np.sqrt((p[0] - x) + 1j * (p[1] - y))
+            root *= np.where(negate, -1.0, 1.0)
+            x, y = root.real, root.imag
+        if selected is None:
+            px[:], py[:] = x, y
+        else:
+            px[selected], py[selected] = x, y
+
+
+def _compiles_faithfully(cls):
+    ''' whether the compile method of cls comes from the same class as (or a subclass of) the methods
+    that move its points and change their colours, so a subclass overriding one of them is not
+    compiled as its parent
+    '''
+    def owner(name):
+        return next(k for k in cls.__mro__ if name in vars(k))
+    return all(issubclass(owner("compile"), owner(name))
+               for name in ("transform", "f", "transform_colour") if hasattr(cls, name))
+
+
+def compile_system(ifs):
+    ''' compile the transforms of ifs into a Table, or return None if any of them
+    cannot be written as one of the families above (see Transform.compile)
+    '''
+    kinds, params, colours, weights = [], [], [], []
+    for weight, t in ifs.transforms:
+        compiled = t.compile() if _compiles_faithfully(type(t)) else None
+        if compiled is None:
+            return None
+        kind, values = compiled
+        kinds.append(kind)
+        params.append(values)
+        colours.append((t.r, t.g, t.b))
+        weights.append(weight)
+    if not kinds:
+        return None
+    return Table(kinds, params, colours, weights)
@@ -0,0 +1,81 @@
+from multiprocessing import cpu_count, get_context
+import os
+import random
+import numpy as np
+from .image import Image
+from .instrument import Profile
+
+
+def split_points(num_points, workers):
+    ''' split num_points into workers nearly equal shares '''
+    share, remainder = divmod(num_points, workers)
+    return [share + 1 if i < remainder else share for i in range(workers)]
+
+
+def _evaluate_share(task):
+    ''' evaluate one share of the points into a fresh image inside a worker process, memory-mapped
+    at buffer_path if it is given, in which case only its path is sent back
+    '''
+    (ifs, width, height, dtype, tile_rows, buffer_path, num_points, iterations, method, seed_sequence, profiled,
+     options) = task
+    image = Image(width, height, dtype=dtype, path=buffer_path, tile_rows=tile_rows)
+    # transforms that draw from the random module themselves are seeded from the same stream
+    random.seed(int(seed_sequence.generate_state(1)[0]))
+    rng = np.random.default_rng(seed_sequence)
+    profile = Profile() if profiled else None
+    ifs.evaluate(image, num_points, iterations, method=method, rng=rng, profile=profile, **options)
+    return image, profile
+
+
+def _seeded_shares(first_point, num_points, workers):
+    ''' split the points from first_point into at most workers runs of consecutive points,
+    returning the first point and number of points of each run
+    '''
+    shares = []
+    for share in split_points(num_points, workers):
+        if share > 0:
+            shares.append((first_point, share))
+            first_point += share
+    return shares
+
+
+def evaluate_parallel(ifs, image, num_points, iterations, workers=None, method="vectorized", seed=None,
+                      first_point=None, profile=None, **options):
+    ''' evaluate the iterated function system with num_points split across a pool of worker processes.
+    each worker accumulates into its own image with an independent random stream spawned from seed
+    and the results are summed into image, a tile at a time. when image is memory-mapped so are the
+    images of the workers, in files next to it that are removed once they are added. without a seed
+    the streams are different every time, with one each worker evaluates a run of the points numbered
+    from first_point (by default image.points) reproducibly, each point from its own stream (see
+    streams.PointStreams), so the image does not depend on the number of workers.
+    if profile is given the workers are profiled too and their
+    timings, summed over workers, are added to it (prefixed "workers/").
+    any other options are passed on to IFS.evaluate in the workers
+    '''
+    workers = workers or cpu_count()
+    seed_sequences = np.random.SeedSequence(seed).spawn(workers)
+    if seed is None:
+        shares = [(None, share) for share in split_points(num_points, workers) if share > 0]
+    else:
+        shares = _seeded_shares(image.points if first_point is None else first_point, num_points, workers)
+    tasks = [(ifs, image.width, image.height, image.data.dtype, image.tile_rows,
+              None if image.path is None else "{}.worker{}".format(image.path, index), share, iterations, method,
+              seed_sequence, profile is not None, dict(options, seed=seed, first_point=point))
+             for index, ((point, share), seed_sequence) in enumerate(zip(shares, seed_sequences))]
+    if not tasks:
+        # nothing left to evaluate, e.g. resuming a finished checkpoint
+        return image
+    # numba's threads do not survive a fork, so jit workers are started afresh (loading the cached kernels)
+    context = get_context("spawn" if method == "jit" else None)
+    with context.Pool(len(tasks)) as pool:
+        for worker_image, worker_profile in pool.imap(_evaluate_share, tasks):
+            image.add_image(worker_image)
+            if worker_image.path is not None:
+                os.remove(worker_image.path)
+                os.remove(worker_image.path + ".counts")
+            if profile is not None:
+                # samples are counted by the caller from the merged image
+                worker_profile.samples = worker_profile.inside = 0
+                worker_profile.phases = {"workers/" + name: seconds for name, seconds in worker_profile.phases.items()}
+                profile.merge(worker_profile)
+    return image
@@ -0,0 +1,66 @@
+from multiprocessing import cpu_count, get_context
+import numpy as np
+from .ifs import IFS
+from . import transform
+from . import streams
+
+# the default transforms of the candidates, as in IFS.random
+DEFAULT_TRANSFORMS = (transform.RandomAffineTransform,
+                      transform.RandomMoebiusTransform,
+                      transform.RandomInverseJuliaTransform)
+
+# candidates outside these limits score 0 whatever their other metrics
+MIN_COVERAGE = 0.02
+MAX_ESCAPE_RATE = 0.5
+
+
+def score(metrics):
+    ''' the default ranking of screened systems: spread evenly (entropy) but not filling the
+    canvas (coverage), with few escaping walkers. degenerate attractors, such as a point or a
+    line, mostly escaping or expanding systems score 0
+    '''
+    if (metrics["coverage"] < MIN_COVERAGE or metrics["escape_rate"] > MAX_ESCAPE_RATE
+            or not metrics["contraction"] < 1):
+        return 0.0
+    return metrics["entropy"] * (1 - metrics["coverage"]) * (1 - metrics["escape_rate"])
+
+
+def candidate(seed, index, count, allowed_transforms=DEFAULT_TRANSFORMS, **options):
+    ''' the candidate index of a search from seed: a system of count random transforms drawn from
+    its own substream, which also drives its screening. returns the system with its viewport fitted
+    and the metrics of IFS.screen, the same every time for the same arguments
+    '''
+    rng = streams.substream(seed, streams.SEARCH, index)
+    ifs = IFS()
+    ifs.random(count, list(allowed_transforms), rng=rng)
+    return ifs, ifs.screen(rng=rng, **options)
+
+
+def _screen_candidate(task):
+    ''' screen one candidate inside a worker process, only the metrics are sent back '''
+    seed, index, count, allowed_transforms, options = task
+    return index, candidate(seed, index, count, allowed_transforms, **options)[1]
+
+
+def search(candidates, count, allowed_transforms=DEFAULT_TRANSFORMS, keep=10, workers=1, seed=None,
+           score=score, **options):
+    ''' screen candidates random systems of count transforms each and return the best keep of them,
+    as (score, system, metrics) sorted best first. the systems are screened across workers processes
+    (None for one per cpu) and only the kept ones are built again in this process, with their viewports
+    fitted. score ranks the metrics of IFS.screen, options (size, num_points, iterations, ...) are
+    passed on to it. with a seed the search is reproducible, without one a seed is drawn
+    '''
+    seed = np.random.SeedSequence().entropy if seed is None else seed
+    tasks = [(seed, index, count, tuple(allowed_transforms), options) for index in range(candidates)]
+    workers = workers or cpu_count()
+    if workers == 1:
+        screened = [_screen_candidate(task) for task in tasks]
+    else:
+        with get_context().Pool(workers) as pool:
+            screened = pool.map(_screen_candidate, tasks, chunksize=max(1, candidates // (workers * 8)))
+    ranked = sorted(screened, key=lambda result: score(result[1]), reverse=True)[:keep]
+    best = []
+    for index, metrics in ranked:
+        ifs, metrics = candidate(seed, index, count, allowed_transforms, **options)
+        best.append((score(metrics), ifs, metrics))
+    return best
@@ -0,0 +1,84 @@
+import numpy as np
+
+# keys of the independent substreams spawned from a seed
+SYSTEM = 0
+VIEWPORT = 1
+POINTS = 2
+SEARCH = 3
+
+# constants of splitmix64, the generator every walker of a seeded evaluation carries
+GOLDEN = np.uint64(0x9E3779B97F4A7C15)
+MIX_1 = np.uint64(0xBF58476D1CE4E5B9)
+MIX_2 = np.uint64(0x94D049BB133111EB)
+
+
+def substream(seed, *key):
+    ''' a numpy generator for the substream of seed identified by key, a tuple of non-negative integers.
+    the same seed and key always give the same stream and different keys give independent streams
+    '''
+    return np.random.default_rng(np.random.SeedSequence(seed, spawn_key=key))
+
+
+def mix(z):
+    ''' the splitmix64 output function of a numpy array of uint64 states '''
+    z = (z ^ (z >> np.uint64(30))) * MIX_1
+    z = (z ^ (z >> np.uint64(27))) * MIX_2
+    return z ^ (z >> np.uint64(31))
+
+
+def uniform(bits):
+    ''' floats in [0, 1) from the top 53 of 64 random bits '''
+    return (bits >> np.uint64(11)) * (1.0 / 9007199254740992.0)
+
+
+def choices(bits, cumulative, total_weight):
+    ''' the transform indices chosen by random bits, given the running totals of the weights '''
+    # the product can round up to the total, which would be past the last transform
+    return np.minimum(np.searchsorted(cumulative, uniform(bits) * total_weight, side="right"), len(cumulative) - 1)
+
+
+def negations(bits):
+    ''' the branches of inverse Julia transforms chosen by random bits, from their lowest bit '''
+    return (bits & np.uint64(1)).astype(bool)
+
+
+class PointStreams:
+    ''' the random streams of count points numbered from first with a seed. every point (walker)
+    runs splitmix64 from a state hashed from the seed and its number, so what it draws does not
+    depend on the other points evaluated with it, in the same batch, checkpoint or process.
+    its first two draws place it in [-1, 1] x [-1, 1] and every step takes one more, whose top
+    bits choose the transform and lowest bit the branch of inverse Julia transforms (see choices
+    and negations)
+    '''
+
+    def __init__(self, seed, first, count):
+        self.seed = seed
+        self.first = first
+        self.count = count
+        key = np.random.SeedSequence(seed, spawn_key=(POINTS,)).generate_state(1, np.uint64)
+        self.states = mix(key + GOLDEN * np.arange(first, first + count, dtype=np.uint64))
+
+    def advanced(self, draws):
+        ''' the splitmix64 states of all the points after draws draws '''
+        return self.states + GOLDEN * np.full(1, draws, dtype=np.uint64)
+
+    def bits(self, draw):
+        ''' the 64 random bits of draw number draw of all the points '''
+        return mix(self.advanced(draw + 1))
+
+    def walk(self, point, first_draw, count):
+        ''' the 64 random bits of count draws from first_draw of one point, numbered from 0 here '''
+        draws = np.arange(first_draw + 1, first_draw + count + 1, dtype=np.uint64)
+        return mix(self.states[point] + GOLDEN * draws)
+
+    def start(self):
+        ''' arrays of the starting x and y of all the points '''
+        return 2 * uniform(self.bits(0)) - 1, 2 * uniform(self.bits(1)) - 1
+
+    def generator(self, point, *key):
+        ''' a numpy generator for transforms that draw random numbers of their own, keyed by the
+        number of a point and key. the scalar engine takes one for every point, the vectorized
+        engine one for every step keyed by the first point, so with transforms like that
+        its image depends on how the points are split up
+        '''
+        return substream(self.seed, POINTS, self.first + point, *key)
@@ -1,19 +1,59 @@
 from abc import ABCMeta, abstractmethod
-from math import cos, sin, pi, atan2, sqrt
+from functools import wraps
+import cmath
+import inspect
+from math import cos, sin, pi, sqrt
 import random
+import numpy as np
+from . import kernel
 
-def random_complex_number():
-    return complex(random.uniform(-1, 1), random.uniform(-1, 1))
+def uniform(low, high, rng=None):
+    ''' a random number between low and high drawn from rng, a numpy generator, or the random module if it is None '''
+    return random.uniform(low, high) if rng is None else rng.uniform(low, high)
+
+def _accepts_rng(method):
+    ''' whether method takes an rng keyword argument, by name or through **kwargs '''
+    parameters = inspect.signature(method).parameters.values()
+    return any((p.name == "rng" and p.kind != p.POSITIONAL_ONLY) or p.kind == p.VAR_KEYWORD for p in parameters)
+
+def _allow_rng(cls, *names):
+    ''' wrap the methods of cls in names that were written without an rng argument, so the engines can
+    pass one (always by keyword) and it is left out of the call
+    '''
+    for name in names:
+        method = vars(cls).get(name)
+        if method is None or not callable(method) or _accepts_rng(method):
+            continue
+        def call(self, *args, rng=None, method=method):
+            return method(self, *args)
+        setattr(cls, name, wraps(method)(call))
+
+def _or_escaped(function, escaped, *args, **kwargs):
+    ''' function(*args, **kwargs), or escaped if it divides by zero (a point on a pole), which the engines
+    treat as diverged
+    '''
+    try:
+        return function(*args, **kwargs)
+    except ZeroDivisionError:
+        return escaped
+
+def random_complex_number(rng=None):
+    return complex(uniform(-1, 1, rng), uniform(-1, 1, rng))
 
 
 class Transform(object):
     ''' a generic representation of a transform '''
     __metaclass__ = ABCMeta
-    def __init__(self, name="blank"):
-        self.r = random.random()
-        self.g = random.random()
-        self.b = random.random()
+    def __init__(self, name="blank", rng=None):
+        ''' the colour is chosen at random, from rng (a numpy generator) if it is given '''
+        self.r = uniform(0, 1, rng)
+        self.g = uniform(0, 1, rng)
+        self.b = uniform(0, 1, rng)
     
+    def set_colour(self, r, g, b):
+        ''' replace the random colour chosen on construction '''
+        self.r, self.g, self.b = r, g, b
+
     def transform_colour(self, r, g, b):
         ''' modify the color of the points iteratively in the drawing'''
         r = (self.r + r) / 2
@@ -21,91 +61,178 @@ class Transform(object):
         b = (self.b + b) / 2
         return r, g, b
 
+    def transform_colour_batch(self, r, g, b):
+        ''' modify the colors of numpy arrays of points '''
+        return (self.r + r) / 2, (self.g + g) / 2, (self.b + b) / 2
+
+    def _transform_colour_pointwise(self, r, g, b):
+        ''' fallback for subclasses with only a scalar transform_colour, applies it one point at a time '''
+        colours = [self.transform_colour(*c) for c in zip(r, g, b)]
+        if not colours:
+            return np.asarray(r, dtype=float), np.asarray(g, dtype=float), np.asarray(b, dtype=float)
+        r, g, b = zip(*colours)
+        return np.array(r, dtype=float), np.array(g, dtype=float), np.array(b, dtype=float)
+
+    def __init_subclass__(cls, **kwargs):
+        ''' subclasses that only define the scalar methods fall back to applying them point by point '''
+        super(Transform, cls).__init_subclass__(**kwargs)
+        # transforms written before the engines passed an rng still work, without one
+        _allow_rng(cls, "transform", "transform_batch")
+        if 'transform' in vars(cls) and 'transform_batch' not in vars(cls):
+            cls.transform_batch = Transform.transform_batch
+        if 'transform_colour' in vars(cls) and 'transform_colour_batch' not in vars(cls):
+            cls.transform_colour_batch = Transform._transform_colour_pointwise
+
     @abstractmethod
-    def transform(self, px, py):
-        ''' perform the transform function '''
+    def transform(self, px, py, rng=None):
+        ''' perform the transform function, rng is an optional numpy random generator
+        for transforms with randomness, the random module is used if it is not passed
+        '''
         pass
 
+    def transform_batch(self, px, py, rng=None):
+        ''' perform the transform on numpy arrays of points, rng is an optional
+        numpy random generator for transforms with randomness. 
+        this default applies transform one point at a time, subclasses override it with a vectorized version
+        '''
+        escaped = (float("inf"), float("inf"))
+        points = [_or_escaped(self.transform, escaped, x, y, rng=rng) for x, y in zip(px, py)]
+        if not points:
+            return np.asarray(px, dtype=float), np.asarray(py, dtype=float)
+        x, y = zip(*points)
+        return np.array(x, dtype=float), np.array(y, dtype=float)
+
+    def compile(self):
+        ''' the (family, parameters) of this transform in the flat table of kernel.compile_system,
+        or None for transforms that can only be evaluated through their methods
+        '''
+        return None
+
     @abstractmethod
     def __dict__(self):
         ''' convert to a dictionary of required parameters '''
         pass
 
+    def __setstate__(self, state):
+        ''' restore attributes when unpickling, the default would try to update __dict__ which is the method above '''
+        for name, value in state.items():
+            setattr(self, name, value)
+
 class LinearTransform(Transform):
     ''' a linear transformation as described by a matrix [[a,b],[c,d]] '''
-    def __init__(self,matrix):
-        super(LinearTransform, self).__init__()
-        (self.a, self.b), (self.c, self.d) = matrix
+    def __init__(self,matrix, rng=None):
+        super(LinearTransform, self).__init__(rng=rng)
+        # the entries are not stored as self.a, self.b, ... as self.b is the blue of the colour
+        (self.xx, self.xy), (self.yx, self.yy) = matrix
             
-    def transform(self, px, py):
-        return (self.a * px + self.b * py, self.c * px + self.d * py)
+    def transform(self, px, py, rng=None):
+        return (self.xx * px + self.xy * py, self.yx * px + self.yy * py)
+
+    def transform_batch(self, px, py, rng=None):
+        return self.transform(px, py)
+
+    def compile(self):
+        return kernel.AFFINE, (self.xx, self.xy, self.yx, self.yy, 0.0, 0.0)
 
     def __str__(self):
-        return "Linear:[[{:+0.5f},{:+0.5f}],[{:+0.5f},{:+0.5f}]]".format(self.a, self.b, self.c, self.d)
+        return "Linear:[[{:+0.5f},{:+0.5f}],[{:+0.5f},{:+0.5f}]]".format(self.xx, self.xy, self.yx, self.yy)
 
     def __dict__(self):
-        return "Linear", {"matrix":[[self.a, self.b], [self.c, self.d]]}
+        return "LinearTransform", {"matrix":[[self.xx, self.xy], [self.yx, self.yy]]}
     
 class RandomLinearTransform(LinearTransform):
     ''' an extension of a linear transformation that randomly is generated '''
-    def __init__(self, bounds=(-1,1)):
-        a = random.uniform(*bounds)
-        b = random.uniform(*bounds)
-        c = random.uniform(*bounds)
-        d = random.uniform(*bounds)
+    def __init__(self, bounds=(-1,1), rng=None):
+        a = uniform(*bounds, rng=rng)
+        b = uniform(*bounds, rng=rng)
+        c = uniform(*bounds, rng=rng)
+        d = uniform(*bounds, rng=rng)
         m = [[a,b],[c,d]]
-        super(RandomLinearTransform, self).__init__(m)
+        super(RandomLinearTransform, self).__init__(m, rng=rng)
 
 class AffineTransform(Transform):
     ''' an affine transfromation, combination of linear transform and translation'''
-    def __init__(self, matrix, translation):
-        super(AffineTransform, self).__init__()
-        (self.a, self.b), (self.c, self.d) = matrix
+    def __init__(self, matrix, translation, rng=None):
+        super(AffineTransform, self).__init__(rng=rng)
+        # the entries are not stored as self.a, self.b, ... as self.b is the blue of the colour
+        (self.xx, self.xy), (self.yx, self.yy) = matrix
         self.xshift, self.yshift = translation
             
-    def transform(self, px, py):
-        return ((self.a * px + self.b * py) + self.xshift,
-                (self.c * px + self.d * py) + self.yshift)
+    def transform(self, px, py, rng=None):
+        return ((self.xx * px + self.xy * py) + self.xshift,
+                (self.yx * px + self.yy * py) + self.yshift)
+
+    def transform_batch(self, px, py, rng=None):
+        return self.transform(px, py)
+
+    def compile(self):
+        return kernel.AFFINE, (self.xx, self.xy, self.yx, self.yy, self.xshift, self.yshift)
 
     def __str__(self):
-        return "Affine:[[{:+0.5f},{:+0.5f}],[{:+0.5f},{:+0.5f}]]+[{:+0.5f},{:+0.5f}]".format(self.a, self.b, self.c, self.d, self.xshift, self.yshift)
+        return "Affine:[[{:+0.5f},{:+0.5f}],[{:+0.5f},{:+0.5f}]]+[{:+0.5f},{:+0.5f}]".format(self.xx, self.xy, self.yx, self.yy, self.xshift, self.yshift)
 
     def __dict__(self):
-        return "AffineTransform", {"matrix":[[self.a, self.b],[self.c, self.d]],
+        return "AffineTransform", {"matrix":[[self.xx, self.xy],[self.yx, self.yy]],
                                    'translation':[self.xshift, self.yshift]}
 
 class RandomAffineTransform(AffineTransform):
     ''' an affine transfromation, combination of linear transform and translation'''
-    def __init__(self, bounds=(-1,1), shift=(-2,2)):
-        a = random.uniform(*bounds)
-        b = random.uniform(*bounds)
-        c = random.uniform(*bounds)
-        d = random.uniform(*bounds)
+    def __init__(self, bounds=(-1,1), shift=(-2,2), rng=None):
+        a = uniform(*bounds, rng=rng)
+        b = uniform(*bounds, rng=rng)
+        c = uniform(*bounds, rng=rng)
+        d = uniform(*bounds, rng=rng)
         m = [[a,b],[c,d]]
-        x = random.uniform(*shift)
-        y = random.uniform(*shift)
+        x = uniform(*shift, rng=rng)
+        y = uniform(*shift, rng=rng)
         s = [x,y]
-        super(RandomAffineTransform, self).__init__(m,s)
+        super(RandomAffineTransform, self).__init__(m,s, rng=rng)
         
 class ComplexTransform(Transform):
     ''' base class for a complex transformation ''' 
-    def transform(self, px, py):
+    def transform(self, px, py, rng=None):
         z = complex(px, py)
-        z2 = self.f(z)
+        z2 = self.f(z, rng=rng)
+        return z2.real, z2.imag
+
+    def __init_subclass__(cls, **kwargs):
+        super(ComplexTransform, cls).__init_subclass__(**kwargs)
+        _allow_rng(cls, "f", "f_batch")
+        if 'f' in vars(cls) and 'f_batch' not in vars(cls):
+            cls.f_batch = ComplexTransform.f_batch
+
+    def transform_batch(self, px, py, rng=None):
+        z2 = self.f_batch(np.asarray(px) + 1j * np.asarray(py), rng=rng)
         return z2.real, z2.imag
 
+    def f_batch(self, z, rng=None):
+        ''' function defining the transformation on a numpy array of complex numbers.
+        this default applies f one number at a time, subclasses override it with a vectorized version
+        '''
+        escaped = complex(float("inf"), float("inf"))
+        return np.array([_or_escaped(self.f, escaped, complex(w), rng=rng) for w in z], dtype=complex)
+
 class MoebiusTransform(ComplexTransform):
-    def __init__(self, a, b, c, d):
-        super(MoebiusTransform, self).__init__()
+    def __init__(self, a, b, c, d, rng=None):
+        super(MoebiusTransform, self).__init__(rng=rng)
         self.pre_a = a
         self.pre_b = b
         self.pre_c = c
         self.pre_d = d
         
-    def f(self, z):
+    def f(self, z, rng=None):
         ''' function defining the transformation '''
         return (self.pre_a * z + self.pre_b) / (self.pre_c * z + self.pre_d)
 
+    def f_batch(self, z, rng=None):
+        # points on the pole become inf or nan and are treated as diverged
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return self.f(z)
+
+    def compile(self):
+        a, b, c, d = (complex(w) for w in (self.pre_a, self.pre_b, self.pre_c, self.pre_d))
+        return kernel.MOEBIUS, (a.real, a.imag, b.real, b.imag, c.real, c.imag, d.real, d.imag)
+
     def __str__(self):
         return "Moebius:(({0.real:.5f}+{0.imag:.5f}i)z+({1.real:.5f}+{1.imag:.5f}i))/(({2.real:.5f}+{2.imag:.5f}i)z+({3.real:.5f}+{3.imag:.5f}i))".format(self.pre_a, self.pre_b, self.pre_c, self.pre_d)
         self.pre_d = d
@@ -117,12 +244,12 @@ class MoebiusTransform(ComplexTransform):
                                     "d":self.pre_d}
         
 class RandomMoebiusTransform(MoebiusTransform):
-    def __init__(self):
-        a = random_complex_number()
-        b = random_complex_number()
-        c = random_complex_number()
-        d = random_complex_number()
-        super(RandomMoebiusTransform, self).__init__(a,b,c,d)
+    def __init__(self, rng=None):
+        a = random_complex_number(rng)
+        b = random_complex_number(rng)
+        c = random_complex_number(rng)
+        d = random_complex_number(rng)
+        super(RandomMoebiusTransform, self).__init__(a,b,c,d, rng=rng)
     
 
 # class MoebiusBase(ComplexTransform):
@@ -143,28 +270,38 @@ class RandomMoebiusTransform(MoebiusTransform):
 #         z2 = (self.post_a * z + self.post_b) / (self.post_c * z + self.post_d)
 
 class InverseJuliaTransform(ComplexTransform):    
-    def __init__(self, r, theta):
-        super(InverseJuliaTransform, self).__init__()
-        self.r = r
+    def __init__(self, r, theta, rng=None):
+        super(InverseJuliaTransform, self).__init__(rng=rng)
+        # the radius is not stored as self.r, which is the red of the colour
+        self.radius = r
         self.theta = theta
-        self.c = complex(self.r * cos(self.theta), self.r * sin(self.theta))
+        self.c = complex(self.radius * cos(self.theta), self.radius * sin(self.theta))
     
-    def f(self, z):
-        z2 = self.c - z
-        theta = atan2(z2.imag, z2.real) * 0.5
-        sqrt_r = random.choice([1, -1]) * ((z2.imag * z2.imag + z2.real * z2.real) ** 0.25)
-        return complex(sqrt_r * cos(theta), sqrt_r * sin(theta))
+    def f(self, z, rng=None):
+        # the principal square root computed algebraically by cmath, with no trigonometry
+        root = cmath.sqrt(self.c - z)
+        negate = random.getrandbits(1) if rng is None else rng.random() >= 0.5
+        return -root if negate else root
+
+    def f_batch(self, z, rng=None):
+        ''' rng is the source of the per-element branch sign, the global numpy state is used if it is not passed '''
+        rng = np.random if rng is None else rng
+        root = np.sqrt(self.c - z)
+        return np.where(rng.random(root.shape) < 0.5, root, -root)
+
+    def compile(self):
+        return kernel.INVERSE_JULIA, (self.c.real, self.c.imag)
 
     def __str__(self):
-        return "Inverse Julia: r={}, theta={}".format(self.r, self.theta)
+        return "Inverse Julia: r={}, theta={}".format(self.radius, self.theta)
 
     def __dict__(self):
-        return "InverseJuliaTransform", {"r": self.r,
+        return "InverseJuliaTransform", {"r": self.radius,
                                          "theta": self.theta}
 
 class RandomInverseJuliaTransform(InverseJuliaTransform):
-    def __init__(self):
-        r = sqrt(random.random()) * 0.4 + 0.8
-        theta = 2 * pi * random.random()
-        super(RandomInverseJuliaTransform, self).__init__(r,theta)
+    def __init__(self, rng=None):
+        r = sqrt(uniform(0, 1, rng)) * 0.4 + 0.8
+        theta = 2 * pi * uniform(0, 1, rng)
+        super(RandomInverseJuliaTransform, self).__init__(r,theta, rng=rng)
         
@@ -1,25 +1,118 @@
 from __future__ import print_function
 import pyifs
 import random, json, argparse, sys
+from pyifs.encoding import ComplexEncoder, decode_complex
 
 def get_args():
     ap = argparse.ArgumentParser()
     ap.add_argument("configuration")
+    ap.add_argument("--workers", type=int, default=None,
+                    help="number of processes to evaluate with, 0 for one per cpu (overrides evaluation_settings)")
+    ap.add_argument("--checkpoint", default=None,
+                    help="path of a checkpoint of the accumulated image and random state")
+    ap.add_argument("--checkpoint-interval", type=int, default=None,
+                    help="number of points between checkpoints, by default only at the end")
+    ap.add_argument("--resume", action="store_true",
+                    help="continue from the checkpoint until num_points have been evaluated")
+    ap.add_argument("--add-points", type=int, default=None,
+                    help="add this many points to the image in the checkpoint")
+    ap.add_argument("--batch-points", type=int, default=None,
+                    help="evaluate this many points at a time, printing progress after each batch")
+    ap.add_argument("--preview", default=None,
+                    help="path of a small preview png updated while evaluating in batches")
+    ap.add_argument("--preview-every", type=int, default=1,
+                    help="number of batches between preview updates")
+    ap.add_argument("--tolerance", type=float, default=None,
+                    help="stop once a batch changes the distribution of samples by less than this")
+    ap.add_argument("--frames", default=None,
+                    help="with the deterministic method, save every step to this format string, e.g. frames/{:03d}.png")
+    ap.add_argument("--cache", default=None,
+                    help="directory of cached renders, an identical render is loaded from it and a larger one continued")
+    ap.add_argument("--cache-size", type=int, default=1024,
+                    help="megabytes the cache may take before the least recently used renders are deleted")
+    ap.add_argument("--profile", default=None,
+                    help="write a json report of where the time went to this path")
     args = ap.parse_args()
+    if args.batch_points and args.checkpoint is not None:
+        ap.error("--batch-points cannot be combined with --checkpoint")
+    if (args.preview or args.tolerance) and not args.batch_points:
+        ap.error("--preview and --tolerance need --batch-points")
+    if (args.resume or args.add_points) and args.checkpoint is None:
+        ap.error("--resume and --add-points need --checkpoint")
+    if args.cache and (args.batch_points or args.checkpoint is not None):
+        ap.error("--cache cannot be combined with --batch-points or --checkpoint")
     return vars(args)
 
-# Since complex numbers are not natively json serializable here is an encoder and decoder to handle them
-class ComplexEncoder(json.JSONEncoder):
-    def default(self, z):
-        if isinstance(z, complex):
-            return {"__complex__":True,"real":z.real,"imag":z.imag}
-        else:
-            super().default(self, z)
+def new_image(config):
+    ''' a blank image as described by the image_settings of a configuration,
+    supersample times larger in each direction than the saved png
+    '''
+    settings = config['image_settings']
+    supersample = settings.get('supersample', 1)
+    return pyifs.image.Image(settings['width'] * supersample, settings['height'] * supersample,
+                             dtype=settings.get('dtype', 'float64'),
+                             path=settings.get('buffer_path'), tile_rows=settings.get('tile_rows'))
 
-def decode_complex(dct):
-    if '__complex__' in dct:
-        return complex(dct['real'], dct['imag'])
-    return dct
+def new_tone_map(config):
+    ''' the tone mapping chosen in image_settings, "ward" (the default) or "log" for log density '''
+    settings = config['image_settings']
+    tone_map = settings.get('tone_map', 'ward')
+    if tone_map == 'log':
+        return pyifs.image.LogDensityToneMap(gamma=settings.get('gamma', 2.2), vibrancy=settings.get('vibrancy', 1.0),
+                                             brightness=settings.get('brightness', 1.0))
+    elif tone_map != 'ward':
+        raise ValueError("unknown tone_map: {}".format(tone_map))
+    return pyifs.image.WardToneMap()
+
+def configure_viewport(config, ifs):
+    ''' set the viewport of the system from image_settings, either [xmin, xmax, ymin, ymax] or "auto" to
+    fit it to the attractor. the estimate is seeded so resuming a checkpoint draws the same region
+    '''
+    settings = config['image_settings']
+    viewport = settings.get('viewport')
+    if viewport == "auto":
+        seed = config['evaluation_settings'].get('seed', 0)
+        ifs.estimate_viewport(aspect=settings['width'] / settings['height'],
+                              rng=pyifs.streams.substream(seed, pyifs.streams.VIEWPORT))
+    elif viewport is not None:
+        ifs.viewport = tuple(viewport)
+
+def new_system(config):
+    ''' the system described by the transforms of a configuration, with its random
+    colours and weights drawn from the seed in evaluation_settings if there is one.
+    instead of transforms a configuration may name a system in a binary file of them with
+    "systems": {"path": ..., "index": ...}
+    '''
+    if 'systems' in config:
+        ifs, = pyifs.binary.load(config['systems']['path'], [config['systems'].get('index', 0)])
+    else:
+        seed = config['evaluation_settings'].get('seed')
+        ifs = pyifs.ifs.IFS()
+        rng = None if seed is None else pyifs.streams.substream(seed, pyifs.streams.SYSTEM)
+        ifs.from_dict(config['transforms'], rng=rng)
+    configure_viewport(config, ifs)
+    return ifs
+
+def new_cache(path, megabytes=1024):
+    ''' the render cache in the directory at path, None if there is no path '''
+    return None if path is None else pyifs.cache.RenderCache(path, max_bytes=megabytes << 20)
+
+def save_outputs(config, ifs, image, profile=None):
+    ''' save the image to the path in image_settings and the system next to it as json '''
+    iterations = config['evaluation_settings']['iterations']
+    settings = config['image_settings']
+    image.save(settings['path'],
+               max(1, (image.points * iterations) / (image.height * image.width)),
+               compression=settings.get('compression', 6), profile=profile, tone_map=new_tone_map(config),
+               supersample=settings.get('supersample', 1), filter=settings.get('filter', 'box'))
+
+    # save system, important if randomized, and the viewport actually drawn
+    out_json = {"image_settings":dict(config['image_settings'], viewport=list(ifs.viewport)),
+                'evaluation_settings':config['evaluation_settings'],
+                "transforms":ifs.to_dict()}
+    out_json_path = "{}.json".format(config['image_settings']['path'].split(".png")[0])
+    with pyifs.instrument.phase(profile, "json dump"), open(out_json_path, "w") as f:
+        f.write(json.dumps(out_json, cls=ComplexEncoder))
 
 if __name__ == "__main__":
     # get arguments
@@ -28,30 +121,62 @@ if __name__ == "__main__":
         config = json.load(f, object_hook=decode_complex)
 
     # read configuration
-    width, height = config['image_settings']['width'], config['image_settings']['height']
+    supersample = config['image_settings'].get('supersample', 1)
+    width = config['image_settings']['width'] * supersample
+    height = config['image_settings']['height'] * supersample
     iterations = config['evaluation_settings']['iterations']
     num_points = config['evaluation_settings']['num_points']
+    method = config['evaluation_settings'].get('method', 'scalar')
+    burn_in = config['evaluation_settings'].get('burn_in', 0)
+    seed = config['evaluation_settings'].get('seed')
+    workers = config['evaluation_settings'].get('workers', 1) if args['workers'] is None else args['workers']
 
-    # initialize system
-    image = pyifs.image.Image(width, height)
-    ifs = pyifs.ifs.IFS()
-    ifs.from_dict(config['transforms'])
+    profile = pyifs.instrument.Profile() if args['profile'] else None
 
+    # initialize system
+    if args['resume'] or args['add_points']:
+        image, checkpoint_iterations, rng, ifs = pyifs.checkpoint.load(
+            args['checkpoint'], buffer_path=config['image_settings'].get('buffer_path'),
+            tile_rows=config['image_settings'].get('tile_rows'))
+        if (image.width, image.height, checkpoint_iterations) != (width, height, iterations):
+            sys.exit("checkpoint was made with a {}x{} image and {} iterations".format(
+                image.width, image.height, checkpoint_iterations))
+        remaining = args['add_points'] or num_points - image.points
+    else:
+        image = new_image(config)
+        rng = ifs = None
+        remaining = num_points
+    # a resumed render carries on with the weights, colours and viewport of the checkpointed system
+    ifs = new_system(config) if ifs is None else ifs
 
     # run!
-    image = ifs.evaluate(image, num_points, iterations)
+    if args['frames'] and method != "deterministic":
+        sys.exit("--frames needs the deterministic method")
+    if method == "deterministic":
+        image = ifs.evaluate_deterministic(image, max(0, remaining), iterations, frame_path=args['frames'],
+                                           profile=profile)
+    elif args['cache']:
+        image = pyifs.cache.evaluate(ifs, image, num_points, iterations, new_cache(args['cache'], args['cache_size']),
+                                     method=method, seed=seed, workers=workers or None, profile=profile,
+                                     burn_in=burn_in)
+    elif args['batch_points']:
+        batches = ifs.evaluate_progressive(image, max(0, remaining), iterations, args['batch_points'],
+                                           method=method, workers=workers or None, seed=seed,
+                                           preview_path=args['preview'], preview_every=args['preview_every'],
+                                           tolerance=args['tolerance'], profile=profile, burn_in=burn_in)
+        for image, points, change in batches:
+            print("{} / {} points".format(points, num_points) +
+                  ("" if change is None else ", change {:.5f}".format(change)))
+    else:
+        image = ifs.evaluate(image, max(0, remaining), iterations, method=method, rng=rng, seed=seed,
+                             workers=workers or None,
+                             checkpoint_path=args['checkpoint'], checkpoint_interval=args['checkpoint_interval'],
+                             profile=profile, burn_in=burn_in)
 
-    #save image
-    image.save(config['image_settings']['path'],
-               max(1, (num_points * iterations) / (height * width)))
+    save_outputs(config, ifs, image, profile=profile)
 
-    # save system, important if randomized
-    out_json = {"image_settings":config['image_settings'],
-                'evaluation_settings':config['evaluation_settings'],
-                "transforms":ifs.to_dict()}
-    out_json_path = "{}.json".format(config['image_settings']['path'].split(".png")[0])
-    with open(out_json_path, "w") as f:
-        f.write(json.dumps(out_json, cls=ComplexEncoder))
+    if profile is not None:
+        profile.save(args['profile'])
     
 
 
@@ -0,0 +1,56 @@
+from __future__ import print_function
+import pyifs
+import argparse, copy, json, os
+from multiprocessing import Pool, cpu_count
+
+from pyifs.encoding import ComplexEncoder, decode_complex
+from batch import render, seed_worker
+
+
+def get_args():
+    ap = argparse.ArgumentParser(description="screen random systems on a small canvas and keep the best ones")
+    ap.add_argument("configuration", help="configuration whose image and evaluation settings the kept systems use")
+    ap.add_argument("output", help="directory for the kept systems, their configurations and renders")
+    ap.add_argument("--candidates", type=int, default=1000, help="number of random systems to screen")
+    ap.add_argument("--transforms", type=int, default=3, help="number of transforms in each system")
+    ap.add_argument("--types", nargs="+", default=None,
+                    help="names of the random transforms to draw from, by default affine, Moebius and inverse Julia")
+    ap.add_argument("--keep", type=int, default=10, help="number of systems to keep")
+    ap.add_argument("--workers", type=int, default=0, help="number of worker processes, 0 for one per cpu")
+    ap.add_argument("--seed", type=int, default=None, help="seed of the search, drawn at random if not given")
+    ap.add_argument("--size", type=int, default=64, help="width of the screening canvas")
+    ap.add_argument("--render", action="store_true", help="render the kept systems at full size")
+    return vars(ap.parse_args())
+
+
+if __name__ == "__main__":
+    args = get_args()
+    with open(args['configuration']) as f:
+        base = json.load(f, object_hook=decode_complex)
+    settings = base['image_settings']
+    allowed = (pyifs.search.DEFAULT_TRANSFORMS if args['types'] is None
+               else [getattr(pyifs.transform, name) for name in args['types']])
+
+    best = pyifs.search.search(args['candidates'], args['transforms'], allowed, keep=args['keep'],
+                               workers=args['workers'] or None, seed=args['seed'], size=args['size'],
+                               aspect=settings['width'] / settings['height'])
+
+    # the kept systems together in a binary file, and a configuration for each
+    os.makedirs(args['output'], exist_ok=True)
+    pyifs.binary.save(os.path.join(args['output'], "systems.ifsb"), [ifs for _, ifs, _ in best])
+    configs = []
+    for rank, (score, ifs, metrics) in enumerate(best):
+        config = copy.deepcopy(base)
+        path = os.path.join(args['output'], "{:04d}".format(rank))
+        config['image_settings'].update(path=path + ".png", viewport=list(ifs.viewport))
+        config['transforms'] = ifs.to_dict()
+        with open(path + ".json", "w") as f:
+            f.write(json.dumps(config, cls=ComplexEncoder))
+        configs.append(config)
+        print("{:04d} score {:.3f}  ".format(rank, score) +
+              "  ".join("{} {:.3f}".format(name, value) for name, value in sorted(metrics.items())))
+
+    if args['render']:
+        with Pool(args['workers'] or cpu_count(), initializer=seed_worker) as pool:
+            for path, samples, seconds in pool.imap_unordered(render, configs):
+                print("{:<40} {:>8.2f}s".format(path, seconds))
@@ -8,6 +8,7 @@ setup(
     description='A Python Iterated Function plotter',
     long_description=open('README.md').read(),
     install_requires=['numpy'],
+    extras_require={'jit': ['numba']},
     url='https://github.com/jmbhughes/pyifs',
     author='J. Marcus Hughes',
     author_email='hughes.jmb@gmail.com'